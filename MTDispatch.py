@@ -0,0 +1,208 @@
+'''
+    Description:
+    The table of the commands a Comm class accepts, built once when the
+    Worker loads it. Text commands are looked up in it by name and their
+    arguments converted to the declared types, clients that send their
+    commands as binary frames look them up by id.
+
+    A client sends COMMANDS to receive the table, a list of
+    [id, method, types, arguments] in its encoding, then INPUT BINARY
+    after which everything it sends is read as frames:
+
+    uint32  length of the rest of the frame, big-endian like all below
+    uint16  id of the command in the table
+    uint32  request id, 0 for none, see the @<id> prefix of MTserver
+    ...     the arguments, packed one after the other by type:
+            'i' int32, 'd' float64, '?' one byte bool and
+            's' uint16 length followed by that many bytes, UTF-8 text
+
+    The types of the arguments are read from the docstring of the
+    method, the line "inputs: channel [int], value [float]" found in
+    the Comm classes, or given with the inputs decorator:
+
+        @MTDispatch.inputs(channel=int, value=float)
+        def CURRENT(self, channel, value):
+
+    Arguments without a type are strings. Methods taking *args accept
+    any arguments as strings and cannot be called with binary frames.
+'''
+
+import re
+import struct
+import inspect
+
+# Type codes of the table by the names used in the docstrings
+TYPE_NAMES = {'int': 'i', 'integer': 'i', 'float': 'd', 'double': 'd',
+              'bool': '?', 'boolean': '?', 'str': 's', 'string': 's'}
+TYPE_CODES = {int: 'i', float: 'd', bool: '?', str: 's'}
+
+BOOLEANS = {'1': True, 'true': True, 'on': True, 'yes': True,
+            '0': False, 'false': False, 'off': False, 'no': False}
+
+HEADER = struct.Struct('>HI')
+COMMAND_ID = struct.Struct('>H')
+
+INPUTS = re.compile(r'inputs?\s*:(.*)', re.IGNORECASE)
+INPUT_TYPE = re.compile(r'(\w+)\s*\[(\w+)\]')
+
+
+def parseBool(text):
+    try:
+        return BOOLEANS[text.lower()]
+    except KeyError:
+        raise ValueError('not a boolean: %r'%(text))
+
+
+# Converts the text of an argument to each type code
+CONVERTERS = {'i': int, 'd': float, '?': parseBool, 's': str}
+
+
+# Decorator declaring the types of the arguments of a Comm method,
+# by name, as python types or as the type names of the docstrings
+def inputs(**types):
+    def declare(method):
+        method.inputTypes = types
+        return method
+    return declare
+
+
+# Argument names, type codes and number of required arguments of a
+# method from its signature and docstring, None if its arguments
+# cannot be told, e.g. *args
+def describeMethod(method):
+    try:
+        spec = inspect.getargspec(method)
+    except TypeError:
+        return None
+    if spec.varargs or spec.keywords:
+        return None
+    names = spec.args[1:] if inspect.ismethod(method) else spec.args
+
+    declared = {}
+    match = INPUTS.search(method.__doc__ or '')
+    if match:
+        for name,typeName in INPUT_TYPE.findall(match.group(1)):
+            declared[name] = TYPE_NAMES.get(typeName.lower(), 's')
+    for name,typeName in getattr(method, 'inputTypes', {}).iteritems():
+        if typeName in TYPE_CODES:
+            declared[name] = TYPE_CODES[typeName]
+        else:
+            declared[name] = TYPE_NAMES.get(str(typeName).lower(), 's')
+    required = len(names) - len(spec.defaults or ())
+    return names, ''.join(declared.get(name, 's') for name in names), required
+
+
+"""
+A Command is one entry of the CommandTable, the method of the Comm
+instance to call and how to convert its arguments. A frame whose
+arguments are all of fixed size is unpacked whole, header included,
+with a single precompiled struct. types is None for a method taking
+*args, which only accepts text commands
+"""
+class Command:
+    def __init__(self, id, name, method, argNames=None, types=None, required=0):
+        self.id = id
+        self.name = name
+        self.method = method
+        self.argNames = argNames
+        self.types = types
+        self.required = required
+        if types is None:
+            self.converters = None
+            self.fixed = None
+        else:
+            self.converters = [CONVERTERS[code] for code in types]
+            if 's' in types:
+                self.fixed = None
+            else:
+                self.fixed = struct.Struct(HEADER.format + types)
+
+    # Converts the arguments of a text command to their types.
+    # Raises ValueError if they do not fit the method
+    def convert(self, args):
+        if self.converters is None:
+            return args
+        if not self.required <= len(args) <= len(self.converters):
+            raise ValueError('%s takes %i to %i arguments, got %i'%(
+                self.name,self.required,len(self.converters),len(args)))
+        try:
+            return [convert(arg) for convert,arg in zip(self.converters, args)]
+        except ValueError as e:
+            raise ValueError('bad argument to %s: %s'%(self.name,e))
+
+    # Returns the request id and the arguments of a frame
+    def unpack(self, frame):
+        if self.types is None:
+            raise ValueError('%s takes no binary frames'%(self.name))
+        if self.fixed is not None:
+            if len(frame) != self.fixed.size:
+                raise ValueError('%s expects %i bytes of arguments'%(self.name,self.fixed.size - HEADER.size))
+            values = self.fixed.unpack(frame)
+            return values[1], values[2:]
+
+        reqid, = struct.unpack_from('>I', frame, 2)
+        offset = HEADER.size
+        args = []
+        for code in self.types:
+            if code == 's':
+                n, = struct.unpack_from('>H', frame, offset)
+                offset += 2
+                args.append(frame[offset:offset+n])
+                offset += n
+            else:
+                arg, = struct.unpack_from('>' + code, frame, offset)
+                offset += struct.calcsize(code)
+                args.append(arg)
+        if offset != len(frame):
+            raise ValueError('%s got %i bytes too many'%(self.name,len(frame) - offset))
+        return reqid, tuple(args)
+
+
+"""
+The CommandTable numbers the public methods of a Comm instance, in
+order of their names starting from 1, and decodes the binary frames
+that call them.
+
+methods is the list of methods the Comm advertises, the result of its
+own METHODSAVAILABLE if it has one, otherwise all of them.
+"""
+class CommandTable:
+    def __init__(self, devicecomm):
+        self.commands = {}
+        self.byName = {}
+        names = sorted(n for n in dir(devicecomm) if not n.startswith('_'))
+        for name in names:
+            attribute = getattr(devicecomm, name)
+            if not callable(attribute):
+                continue
+            # The class attribute, the instance one may be a wrapper
+            described = describeMethod(getattr(devicecomm.__class__, name, attribute)) or ()
+            command = Command(len(self.commands) + 1, name, attribute, *described)
+            self.commands[command.id] = command
+            self.byName[name] = command
+
+        if 'METHODSAVAILABLE' in self.byName:
+            self.methods = list(devicecomm.METHODSAVAILABLE())
+        else:
+            self.methods = [c.name for id,c in sorted(self.commands.items()) if c.name != 'UPDATE']
+
+    # The table as sent to the clients, only the methods
+    # that can be called with binary frames
+    def describe(self):
+        return [[c.id, c.name, c.types, c.argNames] for id,c in sorted(self.commands.items())
+                if c.types is not None]
+
+    # Returns the command, its arguments and the request id of a frame
+    # without its length prefix. Raises ValueError for a bad frame
+    def decode(self, frame):
+        try:
+            command = self.commands[COMMAND_ID.unpack_from(frame, 0)[0]]
+            if command.fixed is not None and len(frame) == command.fixed.size:
+                values = command.fixed.unpack(frame)
+                return command, values[2:], values[1] or None
+            reqid, args = command.unpack(frame)
+            return command, args, reqid or None
+        except KeyError as e:
+            raise ValueError('unknown command id %s'%(e))
+        except struct.error as e:
+            raise ValueError(str(e))
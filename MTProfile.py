@@ -0,0 +1,286 @@
+'''
+    Description:
+    Profiling of the I/O of a Comm class with its device. The transports
+    the Comm class talks through are wrapped while the profiler is
+    attached:
+
+    - the attributes of the Comm instance that are sockets, serial ports
+      or files (anything with sendall, or with write and read)
+    - the ctypes libraries, as attributes or globals of its module, e.g.
+      wd.newp_usb_write_by_key in NewportComm
+    - the os and time modules of its module, for os.write/os.read and
+      for the fixed time.sleep calls between a command and its answer
+
+    Every write starts a device command, its key is the text written
+    with the numbers replaced by #, e.g. "SOUR:CURR:LEV #,(@#)". The
+    reads that follow are its answer. The round trip runs from the start
+    of the write to the end of the last read, and includes any sleep in
+    between. A command whose sleeps take more than SLEEP_DOMINATED of its
+    round trip is flagged: the device answered faster than the Comm
+    class waits for it. A call to any other function of a ctypes library
+    is a command of its own, keyed by the name of the function.
+
+    Transports created after the profiler was attached, e.g. when a Comm
+    class reconnects, are only wrapped when it is attached again, and
+    detaching the profiler leaves them in place.
+'''
+
+import re
+import sys
+import os
+import time
+import threading
+import ctypes
+
+import MTStats
+from MTTrace import tracer
+
+# Methods of a transport that send a command and that read the answer
+WRITE_METHODS = ['sendall', 'send', 'write', 'newp_usb_write_by_key']
+READ_METHODS = ['recv', 'recv_into', 'read', 'readline', 'readlines', 'newp_usb_read_by_key']
+
+# Fraction of the round trip of a command spent in fixed sleeps above
+# which it is flagged
+SLEEP_DOMINATED = 0.5
+
+# Most distinct commands kept, the others are counted together
+MAX_COMMANDS = 200
+
+# Longest command key in characters
+MAX_KEY_LENGTH = 60
+
+NUMBER = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+
+# Key of a command from the data written, the numbers it carries are
+# the arguments and do not make a different command
+def commandKey(data):
+    if not data:
+        return '(empty)'
+    text = data.strip()
+    if any(c < ' ' or c > '~' for c in text):
+        return '(binary)'
+    return NUMBER.sub('#', text)[:MAX_KEY_LENGTH]
+
+
+# The data of a write: the last string among the arguments, a ctypes
+# string buffer counting as its value
+def writtenData(args):
+    for arg in reversed(args):
+        if isinstance(arg, str):
+            return arg
+        if isinstance(arg, ctypes.Array) and isinstance(getattr(arg, 'value', None), str):
+            return arg.value
+    return ''
+
+
+"""
+The statistics of one device command: its round trips, the part of
+them spent sleeping and the bytes written and read
+"""
+class CommandStats:
+    def __init__(self):
+        self.roundTrip = MTStats.LatencyStats()
+        self.sleep = 0.0
+        self.bytesOut = 0
+        self.bytesIn = 0
+
+    # Fraction of the round trips spent in fixed sleeps
+    def sleepShare(self):
+        return self.sleep / self.roundTrip.total if self.roundTrip.total > 0 else 0.0
+
+
+"""
+The TransportProxy stands in for a transport, a module or a ctypes
+library and has its writes, reads, sleeps and library calls recorded
+by the profiler. Everything else is passed through unchanged
+"""
+class TransportProxy(object):
+    def __init__(self, target, profiler, library=False):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_profiler', profiler)
+        object.__setattr__(self, '_library', library)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        if name in WRITE_METHODS:
+            return self._profiler.wrapWrite(attribute)
+        if name in READ_METHODS:
+            return self._profiler.wrapRead(attribute)
+        if name == 'sleep' and self._target is time:
+            return self._profiler.wrapSleep(attribute)
+        if self._library and not name.startswith('_'):
+            return self._profiler.wrapCall(name, attribute)
+        return attribute
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+
+"""
+The DeviceProfiler wraps the transports of a Comm instance and keeps
+the CommandStats of every command sent through them. The Worker tells
+it which method of the Comm class is running with begin and end, the
+sleeps outside of any command are counted for that method.
+"""
+class DeviceProfiler:
+    def __init__(self, devicecomm):
+        self.devicecomm = devicecomm
+        self.attached = False
+        self.wrapped = []
+        self.commands = {}
+        self.method = None
+        # The command whose answer is being read:
+        # [key, start, end, sleep, bytesOut, bytesIn]
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def attach(self):
+        if self.attached:
+            return
+        comm = self.devicecomm
+        for name,value in vars(comm).items():
+            if self.isLibrary(value):
+                self.wrap(comm, name, value, True)
+            elif self.isTransport(value):
+                self.wrap(comm, name, value, False)
+        module = sys.modules.get(comm.__class__.__module__)
+        if module is not None:
+            for name,value in vars(module).items():
+                if self.isLibrary(value):
+                    self.wrap(module, name, value, True)
+                elif value is time or value is os:
+                    self.wrap(module, name, value, False)
+        self.attached = True
+
+    # Transports replaced while attached, e.g. by a reconnect, are
+    # kept, only the proxies still in place are taken out again
+    def detach(self):
+        self.attached = False
+        for owner,name,value,proxy in self.wrapped:
+            if vars(owner).get(name) is proxy:
+                setattr(owner, name, value)
+        self.wrapped = []
+        self.pending = None
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.commands = {}
+        finally:
+            self.lock.release()
+
+    def isLibrary(self, value):
+        return isinstance(value, ctypes.CDLL)
+
+    def isTransport(self, value):
+        if isinstance(value, (type, TransportProxy)) or type(value).__name__ == 'module':
+            return False
+        return callable(getattr(value, 'sendall', None)) or (
+            callable(getattr(value, 'write', None)) and callable(getattr(value, 'read', None)))
+
+    def wrap(self, owner, name, value, library):
+        proxy = TransportProxy(value, self, library)
+        setattr(owner, name, proxy)
+        self.wrapped.append((owner, name, value, proxy))
+
+    # Called by the Worker around each call to the Comm class
+    def begin(self, method):
+        self.method = method
+
+    def end(self):
+        self.finish()
+        self.method = None
+
+    def stats(self, key):
+        stats = self.commands.get(key)
+        if stats is None:
+            self.lock.acquire()
+            try:
+                if len(self.commands) >= MAX_COMMANDS:
+                    key = '(other)'
+                stats = self.commands.setdefault(key, CommandStats())
+            finally:
+                self.lock.release()
+        return stats
+
+    # Records the command waiting for its answer, if any
+    def finish(self):
+        pending = self.pending
+        if pending is None:
+            return
+        self.pending = None
+        key,start,end,sleep,bytesOut,bytesIn = pending
+        stats = self.stats(key)
+        stats.roundTrip.add(end - start)
+        stats.sleep += sleep
+        stats.bytesOut += bytesOut
+        stats.bytesIn += bytesIn
+        if tracer.enabled:
+            tracer.complete('io ' + key, start, end, 'device', sleep=sleep, bytesOut=bytesOut, bytesIn=bytesIn)
+
+    def wrapWrite(self, func):
+        def write(*args, **kwargs):
+            self.finish()
+            start = MTStats.monotonic()
+            result = func(*args, **kwargs)
+            data = writtenData(args)
+            self.pending = [commandKey(data), start, MTStats.monotonic(), 0.0, len(data), 0]
+            return result
+        return write
+
+    def wrapRead(self, func):
+        def read(*args, **kwargs):
+            result = func(*args, **kwargs)
+            pending = self.pending
+            if pending is not None:
+                pending[2] = MTStats.monotonic()
+                if isinstance(result, str):
+                    pending[5] += len(result)
+                elif isinstance(result, (int, long)) and func.__name__ == 'recv_into':
+                    pending[5] += result
+            return result
+        return read
+
+    def wrapCall(self, name, func):
+        def call(*args, **kwargs):
+            self.finish()
+            start = MTStats.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.pending = [name, start, MTStats.monotonic(), 0.0, 0, 0]
+                self.finish()
+        return call
+
+    def wrapSleep(self, func):
+        def sleep(seconds):
+            start = MTStats.monotonic()
+            func(seconds)
+            end = MTStats.monotonic()
+            pending = self.pending
+            if pending is not None:
+                pending[3] += end - start
+                pending[2] = end
+            elif self.method is not None:
+                stats = self.stats('(sleep in %s)'%(self.method))
+                stats.roundTrip.add(end - start)
+                stats.sleep += end - start
+            if tracer.enabled:
+                tracer.complete('sleep', start, end, 'device', seconds=seconds)
+        return sleep
+
+    # The commands with their statistics, the slowest in total first
+    def slowest(self):
+        return sorted(self.commands.items(), key=lambda item: -item[1].roundTrip.total)
+
+    def report(self):
+        lines = []
+        for key,stats in self.slowest():
+            flag = '  SLEEP DOMINATED' if stats.sleepShare() > SLEEP_DOMINATED else ''
+            lines.append('%-40s total: %.3fs sleep: %.0f%% out: %iB in: %iB%s'%(
+                key, stats.roundTrip.total, 100*stats.sleepShare(), stats.bytesOut, stats.bytesIn, flag))
+            lines.append('\t%s'%(stats.roundTrip.summary()))
+        return '\n'.join(lines)
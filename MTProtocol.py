@@ -0,0 +1,421 @@
+'''
+    Description:
+    Encoding of the messages published by the Worker. Every broadcast
+    is wrapped in a Message that builds its frame, the encoded message
+    prefixed with its length as a big-endian uint32, at most once per
+    encoding. The same string is then queued for every client and
+    written to their sockets without being copied again.
+
+    Message types:
+    STATUS <time> <state>   full internal_state of the device
+    DELTA <time> <changes>  only the keys whose value changed since the
+                            previous broadcast, sent to clients that
+                            enabled it with the DELTA ON command
+    <HEADER> <time> <data>  replies of the worker, METHODS, PLOT...
+
+    A reply to a request tagged with @<id> by the client carries the
+    id, as <HEADER>@<id> in REPR and as "id" in JSON and BINARY.
+
+    Clients send commands as lines ending in a newline, which the
+    LineFramer reassembles from whatever pieces TCP delivers them in.
+    After INPUT BINARY they send length-prefixed frames instead, read
+    by the FrameReader, see MTDispatch.
+
+    Encodings, chosen by each client with the ENCODING command:
+    REPR    "<HEADER> <time> <str(data)>" as the server always sent
+    JSON    {"type": <HEADER>, "time": <time>, "data": <data>}, strict JSON,
+            NumPy values become lists and numbers, NaN becomes null
+    BINARY  the same map as JSON in MessagePack. NumPy arrays are sent
+            as extension type 1: one byte dtype length, the dtype string
+            (e.g. '<f8'), one byte ndim, ndim little-endian uint32 with
+            the shape and the raw little-endian data in C order
+'''
+
+import struct
+import json
+
+import MTStats
+from MTTrace import tracer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Clients in delta mode receive a full STATUS at least this often,
+# in seconds, so that they can recover from any missed update
+KEYFRAME_INTERVAL = 10.0
+
+NUMPY_EXT_TYPE = 1
+
+# Longest command line in bytes accepted from a client, longer
+# lines are dropped
+MAX_LINE_LENGTH = 1 << 20
+
+
+def encodeRepr(header, timestamp, data, reqid=None):
+    if reqid is not None:
+        header = str(header) + "@" + str(reqid)
+    return str(header) + " " + str(timestamp) + " " + str(data)
+
+
+# NumPy values that the json module does not handle
+def jsonDefault(obj):
+    if numpy is not None:
+        if isinstance(obj, numpy.ndarray):
+            return obj.tolist()
+        if isinstance(obj, numpy.generic):
+            return obj.item()
+    return str(obj)
+
+
+# Replaces NaN and infinity, which strict JSON does not allow, the
+# keys JSON has no place for, e.g. tuples, with their repr and strings
+# that are not UTF-8 with their repr
+def jsonFinite(obj):
+    if isinstance(obj, float):
+        if obj != obj or obj in (float('inf'), float('-inf')):
+            return None
+        return obj
+    if isinstance(obj, str):
+        try:
+            obj.decode('utf-8')
+        except UnicodeDecodeError:
+            return repr(obj)
+        return obj
+    if isinstance(obj, dict):
+        return dict((jsonKey(k), jsonFinite(v)) for k,v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [jsonFinite(v) for v in obj]
+    if numpy is not None and isinstance(obj, (numpy.ndarray, numpy.generic)):
+        return jsonFinite(jsonDefault(obj))
+    return obj
+
+
+# A dictionary key as JSON takes it
+def jsonKey(key):
+    if key is None or isinstance(key, (basestring, int, long, float, bool)):
+        return jsonFinite(key)
+    return repr(key)
+
+
+def encodeJSON(header, timestamp, data, reqid=None):
+    msg = {"type": header, "time": timestamp, "data": data}
+    if reqid is not None:
+        msg["id"] = reqid
+    try:
+        return json.dumps(msg, default=jsonDefault, allow_nan=False, separators=(',',':'))
+    except (ValueError, TypeError):
+        return json.dumps(jsonFinite(msg), default=jsonDefault, allow_nan=False, separators=(',',':'))
+
+
+# Appends the MessagePack encoding of obj to the list out
+def packBinary(obj, out):
+    if obj is None:
+        out.append('\xc0')
+    elif obj is True:
+        out.append('\xc3')
+    elif obj is False:
+        out.append('\xc2')
+    elif isinstance(obj, (int, long)):
+        if 0 <= obj < 0x80:
+            out.append(chr(obj))
+        elif -0x20 <= obj < 0:
+            out.append(struct.pack('b', obj))
+        elif 0 <= obj < 2**64:
+            out.append('\xcf' + struct.pack('>Q', obj))
+        elif -2**63 <= obj < 0:
+            out.append('\xd3' + struct.pack('>q', obj))
+        else:
+            packBinary(str(obj), out)
+    elif isinstance(obj, float):
+        out.append('\xcb' + struct.pack('>d', obj))
+    elif isinstance(obj, (str, unicode)):
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        n = len(obj)
+        if n < 32:
+            out.append(chr(0xa0 | n))
+        elif n < 2**8:
+            out.append('\xd9' + chr(n))
+        elif n < 2**16:
+            out.append('\xda' + struct.pack('>H', n))
+        else:
+            out.append('\xdb' + struct.pack('>I', n))
+        out.append(obj)
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(chr(0x90 | n))
+        elif n < 2**16:
+            out.append('\xdc' + struct.pack('>H', n))
+        else:
+            out.append('\xdd' + struct.pack('>I', n))
+        for item in obj:
+            packBinary(item, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(chr(0x80 | n))
+        elif n < 2**16:
+            out.append('\xde' + struct.pack('>H', n))
+        else:
+            out.append('\xdf' + struct.pack('>I', n))
+        for key,value in obj.iteritems():
+            packBinary(key, out)
+            packBinary(value, out)
+    elif numpy is not None and isinstance(obj, numpy.ndarray) and obj.dtype.kind in 'biuf':
+        packArray(obj, out)
+    elif numpy is not None and isinstance(obj, (numpy.ndarray, numpy.generic)):
+        packBinary(obj.tolist(), out)
+    else:
+        packBinary(str(obj), out)
+
+
+def packArray(arr, out):
+    arr = numpy.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+    dtype = arr.dtype.str
+    payload = (chr(len(dtype)) + dtype + chr(arr.ndim) +
+               struct.pack('<%iI'%(arr.ndim), *arr.shape) + arr.tostring())
+    n = len(payload)
+    if n < 2**8:
+        out.append('\xc7' + chr(n) + chr(NUMPY_EXT_TYPE))
+    elif n < 2**16:
+        out.append('\xc8' + struct.pack('>H', n) + chr(NUMPY_EXT_TYPE))
+    else:
+        out.append('\xc9' + struct.pack('>I', n) + chr(NUMPY_EXT_TYPE))
+    out.append(payload)
+
+
+def encodeBinary(header, timestamp, data, reqid=None):
+    msg = {"type": header, "time": timestamp, "data": data}
+    if reqid is not None:
+        msg["id"] = reqid
+    out = []
+    packBinary(msg, out)
+    return ''.join(out)
+
+
+ENCODERS = {'REPR': encodeRepr, 'JSON': encodeJSON, 'BINARY': encodeBinary}
+
+# Time spent encoding the messages, by encoding
+encodeTimes = dict((encoding, MTStats.LatencyStats()) for encoding in ENCODERS)
+
+
+LENGTH = struct.Struct('>I')
+
+
+# Prefixes an encoded message with its length, as sent to the clients
+def frame(payload):
+    return LENGTH.pack(len(payload)) + payload
+
+
+# Copies a value of internal_state or a reply down through its
+# dictionaries and lists, which the worker may change in place, NumPy
+# arrays included
+def copyState(obj):
+    if isinstance(obj, dict):
+        return dict((k, copyState(v)) for k,v in obj.iteritems())
+    if isinstance(obj, list):
+        return [copyState(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(copyState(v) for v in obj)
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return obj.copy()
+    return obj
+
+
+# Compares two values of internal_state, NumPy arrays
+# do not compare to a single boolean
+def valueChanged(old, new):
+    try:
+        return bool(old != new)
+    except (ValueError, TypeError):
+        try:
+            return old.shape != new.shape or bool((old != new).any())
+        except Exception:
+            return True
+
+
+"""
+A Message is a header with a timestamp and the data that goes with it,
+encoded and framed on demand and remembered for each encoding
+"""
+class Message:
+    def __init__(self, header, timestamp, data, reqid=None):
+        self.header = header
+        self.timestamp = timestamp
+        self.data = data
+        self.reqid = reqid
+        self.frames = {}
+
+    def frame(self, encoding='REPR'):
+        if encoding not in self.frames:
+            start = MTStats.monotonic()
+            self.frames[encoding] = frame(ENCODERS[encoding](self.header, self.timestamp, self.data, self.reqid))
+            end = MTStats.monotonic()
+            encodeTimes[encoding].add(end - start)
+            if tracer.enabled:
+                tracer.complete('encode ' + self.header, start, end, 'encode', encoding=encoding,
+                                bytes=len(self.frames[encoding]))
+        return self.frames[encoding]
+
+
+"""
+The Snapshot is the STATUS message of a single broadcast of the device
+state, together with the keys that changed since the previous one.
+
+The state must be a copy made with copyState on the worker thread, the
+snapshot keeps it as is, so that values the worker changes in place are
+still compared against the previous broadcast. If the set of keys
+changes, the snapshot is marked as a keyframe and every client gets
+the full state.
+"""
+class Snapshot(Message):
+    def __init__(self, state, previous, timestamp):
+        Message.__init__(self, 'STATUS', timestamp, state)
+        self.state = self.data
+
+        if previous is None or len(previous) != len(self.state):
+            self.keyframe = True
+            self.changed = self.state
+        else:
+            self.keyframe = False
+            self.changed = {}
+            for key,value in self.state.iteritems():
+                if key not in previous:
+                    self.keyframe = True
+                    self.changed = self.state
+                    break
+                if valueChanged(previous[key], value):
+                    self.changed[key] = value
+
+        self.deltaMessage = Message('DELTA', timestamp, self.changed)
+        self.subsets = {}
+
+    # The part of the snapshot with only the given keys, shared by all
+    # clients subscribed to the same keys. None stands for all keys
+    def subset(self, keys):
+        if keys is None:
+            return self
+        if keys not in self.subsets:
+            self.subsets[keys] = SnapshotSubset(self, keys)
+        return self.subsets[keys]
+
+
+"""
+The SnapshotSubset holds the STATUS and DELTA messages of a Snapshot
+restricted to a set of keys
+"""
+class SnapshotSubset(Message):
+    def __init__(self, snapshot, keys):
+        state = snapshot.state
+        Message.__init__(self, 'STATUS', snapshot.timestamp, dict((k, state[k]) for k in keys if k in state))
+
+        if len(snapshot.changed) < len(keys):
+            self.changed = dict((k,v) for k,v in snapshot.changed.iteritems() if k in keys)
+        else:
+            self.changed = dict((k, snapshot.changed[k]) for k in keys if k in snapshot.changed)
+        self.deltaMessage = Message('DELTA', snapshot.timestamp, self.changed)
+
+
+"""
+The LineFramer splits the stream of bytes received from a client into
+command lines. The data received is appended to a single bytearray,
+a line is only returned once its newline has arrived, however many
+pieces it came in, so a line can be of any length up to maxLength.
+A longer line is dropped up to its newline and counted in dropped.
+Carriage returns at the end of lines and empty lines are skipped.
+"""
+class LineFramer:
+    def __init__(self, maxLength=None):
+        self.maxLength = maxLength or MAX_LINE_LENGTH
+        self.buffer = bytearray()
+        # Everything before scanned is known to hold no newline
+        self.scanned = 0
+        self.discarding = False
+        self.dropped = 0
+
+    # Adds received data, a string or a view of a receive buffer,
+    # and returns the complete lines it ended. A line equal to until
+    # is the last one returned, the data after it stays in the buffer
+    def feed(self, data, until=None):
+        self.buffer += data
+        lines = []
+        start = 0
+        end = self.buffer.find('\n', self.scanned)
+        while end >= 0:
+            if self.discarding:
+                self.discarding = False
+            elif end - start > self.maxLength:
+                self.dropped += 1
+            else:
+                line = str(self.buffer[start:end]).rstrip('\r')
+                if line:
+                    lines.append(line)
+                if line == until:
+                    start = end + 1
+                    break
+            start = end + 1
+            end = self.buffer.find('\n', start)
+
+        del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        if self.scanned > self.maxLength:
+            if not self.discarding:
+                self.dropped += 1
+            self.discarding = True
+            del self.buffer[:]
+            self.scanned = 0
+        return lines
+
+    # Returns and forgets the data received after the last line
+    def rest(self):
+        data = str(self.buffer)
+        del self.buffer[:]
+        self.scanned = 0
+        return data
+
+
+"""
+The FrameReader is the LineFramer of binary clients, it splits the
+received data into frames prefixed with their length as a big-endian
+uint32 and returns them without the prefix. A frame longer than
+maxLength is skipped and counted in dropped.
+"""
+class FrameReader:
+    def __init__(self, maxLength=None):
+        self.maxLength = maxLength or MAX_LINE_LENGTH
+        # A string rather than a bytearray, frames are sliced out
+        # of it with a single copy
+        self.buffer = ''
+        self.skip = 0
+        self.dropped = 0
+
+    def feed(self, data):
+        buf = self.buffer + memoryview(data).tobytes()
+        frames = []
+        start = 0
+        end = len(buf)
+        unpack = LENGTH.unpack_from
+        while True:
+            if self.skip:
+                skipped = min(self.skip, end - start)
+                self.skip -= skipped
+                start += skipped
+                if self.skip:
+                    break
+            if end - start < 4:
+                break
+            length, = unpack(buf, start)
+            if length > self.maxLength:
+                self.dropped += 1
+                self.skip = length
+                start += 4
+                continue
+            if end - start - 4 < length:
+                break
+            frames.append(buf[start+4:start+4+length])
+            start += 4 + length
+        self.buffer = buf[start:]
+        return frames
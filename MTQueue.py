@@ -0,0 +1,268 @@
+'''
+    Description:
+    The work queue of the Worker. It is used like a python Queue.Queue
+    (put, get, task_done, join), with four differences:
+
+    - tasks that would only repeat the work of a task that is still
+      waiting are collapsed into the waiting one, so that a backlog of
+      periodic UPDATEs costs a single device read
+    - a setpoint command replaces a waiting command for the same setpoint,
+      so that only the last value of a slider drag reaches the device
+    - tasks are served by priority class, commands from the clients go
+      ahead of long reads and of the periodic polling. A class that has
+      waited longer than its MAX_WAIT is served first, so polling still
+      happens under a constant stream of commands
+    - within a class, the tasks of each client wait in their own queue
+      and the clients are served in turn, so a script sending thousands
+      of commands does not lock out the other clients. A client with
+      MAX_CLIENT_TASKS tasks waiting is held back until the worker
+      catches up with it
+'''
+
+import threading
+import collections
+
+import MTStats
+from MTTrace import tracer
+
+# Priority classes, from first to last served
+COMMAND = 0
+READ = 1
+POLL = 2
+PRIORITY_NAMES = ['COMMAND', 'READ', 'POLL']
+
+# Longest time in seconds a task of each class waits behind tasks of
+# higher priority before it is served anyway, None for no limit
+MAX_WAIT = [None, 2.0, 2.0]
+
+# Number of tasks a single client can have waiting before the
+# next one it puts blocks
+MAX_CLIENT_TASKS = 100
+
+
+"""
+The WorkQueue is a priority queue of Worker Tasks, FIFO within each
+priority class.
+
+coalesceKey(task) returns None for tasks that must all be executed and
+a key for tasks that are idempotent, a task put while another one with
+the same key is still waiting is dropped and counted in coalesced,
+per task type.
+
+collapseKey(task) returns a key for setpoint commands where only the
+last value counts. A task put while another one with the same key is
+still waiting takes its place in the queue, the waiting command is
+counted in collapsed. Taking the place rather than going to the end
+keeps the new value ahead of any command that depends on it.
+
+priority(task) returns the priority class of the task. The time each
+task waited in the queue is recorded in waitTimes for its class.
+
+Tasks are queued per client, task.client, and the clients take turns
+within each class, weights gives the number of tasks in a row a client
+gets, 1 by default. Tasks without a client, from the Updater and the
+console, share one queue and are never held back. Putting the task of
+a client that already has MAX_CLIENT_TASKS waiting blocks until half of
+them are served or until release is called for that client.
+"""
+class WorkQueue:
+    def __init__(self, coalesceKey=None, priority=None, collapseKey=None):
+        self.coalesceKey = coalesceKey
+        self.priority = priority
+        self.collapseKey = collapseKey
+        self.weights = {}
+        self.classes = [FairQueue(self.weights) for name in PRIORITY_NAMES]
+        self.pending = {}
+        self.depths = collections.defaultdict(int)
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)
+        self.allDone = threading.Condition(lock)
+        self.space = threading.Condition(lock)
+        self.unfinished = 0
+
+        # Called with a client held back once it is down to half of
+        # MAX_CLIENT_TASKS, for an event loop that has to be woken up
+        self.resume = None
+
+        self.coalesced = collections.defaultdict(int)
+        self.collapsed = collections.defaultdict(int)
+        self.waitTimes = [MTStats.LatencyStats() for name in PRIORITY_NAMES]
+
+    def qsize(self):
+        return sum(len(items) for items in self.classes)
+
+    # Number of tasks of a client waiting in the queue
+    def depth(self, source):
+        return self.depths.get(source, 0)
+
+    # True if the next task of the client would block
+    def full(self, source):
+        return source is not None and self.depths.get(source, 0) >= MAX_CLIENT_TASKS
+
+    def setWeight(self, source, weight):
+        self.weights[source] = max(1, int(weight))
+
+    # Called when a client disconnects, a put of that client blocked
+    # on a full queue goes through. Its waiting tasks are still served
+    def release(self, source):
+        self.condition.acquire()
+        try:
+            self.weights.pop(source, None)
+            self.space.notifyAll()
+        finally:
+            self.condition.release()
+
+    def put(self, task, block=True):
+        self.putAll([task], block)
+
+    # Puts a batch of tasks in order, taking the lock only once
+    def putAll(self, tasks, block=True):
+        for task in tasks:
+            self.classify(task)
+
+        self.condition.acquire()
+        try:
+            for task in tasks:
+                self.add(task, block)
+        finally:
+            self.condition.release()
+
+    def classify(self, task):
+        task.coalesceKey = self.coalesceKey(task) if self.coalesceKey else None
+        task.collapse = False
+        if task.coalesceKey is None and self.collapseKey:
+            task.coalesceKey = self.collapseKey(task)
+            task.collapse = task.coalesceKey is not None
+        task.priority = self.priority(task) if self.priority else COMMAND
+        task.traceId = None
+
+    # Called with the lock held
+    def add(self, task, block):
+        key = task.coalesceKey
+        source = task.client
+        while True:
+            if key is not None and key in self.pending:
+                if task.collapse:
+                    self.pending[key].text = task.text
+                    self.pending[key].args = task.args
+                    self.collapsed[task.text.split(' ', 1)[0]] += 1
+                else:
+                    self.coalesced[task.text.split(' ', 1)[0]] += 1
+                return
+            if not (block and self.full(source) and source.running):
+                break
+            self.space.wait()
+
+        task.enqueued = MTStats.monotonic()
+        if tracer.enabled:
+            task.traceId = tracer.newId()
+            task.traceName = task.text.split(' ', 1)[0]
+            tracer.begin(task.traceName, task.traceId, task.enqueued, text=task.text[:100])
+            tracer.begin('wait', task.traceId, task.enqueued, priority=PRIORITY_NAMES[task.priority])
+        if key is not None:
+            self.pending[key] = task
+        self.classes[task.priority].append(task)
+        self.depths[source] += 1
+        self.unfinished += 1
+        self.condition.notify()
+
+    # Blocks until there is a task waiting
+    def get(self):
+        self.condition.acquire()
+        try:
+            while not self.qsize():
+                self.condition.wait()
+
+            now = MTStats.monotonic()
+            items = self.nextClass(now)
+            task = items.popleft()
+            if task.coalesceKey is not None and self.pending.get(task.coalesceKey) is task:
+                del self.pending[task.coalesceKey]
+            self.depths[task.client] -= 1
+            if self.depths[task.client] == MAX_CLIENT_TASKS // 2:
+                self.space.notifyAll()
+                if self.resume is not None:
+                    self.resume(task.client)
+            if not self.depths[task.client]:
+                del self.depths[task.client]
+            self.waitTimes[task.priority].add(now - task.enqueued)
+            if task.traceId is not None:
+                tracer.end('wait', task.traceId, now)
+            return task
+        finally:
+            self.condition.release()
+
+    # The class to serve next: the one whose oldest task waited the
+    # longest past its MAX_WAIT, otherwise the highest priority one
+    def nextClass(self, now):
+        starving = None
+        for priority,items in enumerate(self.classes):
+            if items and MAX_WAIT[priority] is not None and now - items.oldest() > MAX_WAIT[priority]:
+                if starving is None or items.oldest() < starving.oldest():
+                    starving = items
+        if starving is not None:
+            return starving
+        for items in self.classes:
+            if items:
+                return items
+
+    def task_done(self):
+        self.condition.acquire()
+        try:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.allDone.notifyAll()
+        finally:
+            self.condition.release()
+
+    # Blocks until every task put so far has been processed
+    def join(self):
+        self.condition.acquire()
+        try:
+            while self.unfinished > 0:
+                self.allDone.wait()
+        finally:
+            self.condition.release()
+
+
+"""
+The FairQueue holds the tasks of one priority class, in a deque per
+client. The clients with tasks waiting take turns, each one getting
+as many tasks in a row as its weight before the next one is served.
+"""
+class FairQueue:
+    def __init__(self, weights):
+        self.weights = weights
+        self.queues = {}
+        self.turns = collections.deque()
+        self.served = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, task):
+        if task.client not in self.queues:
+            self.queues[task.client] = collections.deque()
+            self.turns.append(task.client)
+        self.queues[task.client].append(task)
+        self.count += 1
+
+    def popleft(self):
+        source = self.turns[0]
+        items = self.queues[source]
+        task = items.popleft()
+        self.count -= 1
+        self.served += 1
+        if not items:
+            del self.queues[source]
+            self.turns.popleft()
+            self.served = 0
+        elif self.served >= self.weights.get(source, 1):
+            self.turns.rotate(-1)
+            self.served = 0
+        return task
+
+    # Time the oldest waiting task was put
+    def oldest(self):
+        return min(items[0].enqueued for items in self.queues.itervalues())
@@ -0,0 +1,188 @@
+'''
+    Description:
+    Timing helpers shared by the server and the worker: a monotonic
+    clock, which python 2 does not provide, LatencyStats which keeps a
+    histogram of durations in seconds, and the Metrics registry that
+    exports them together with counters, as a dictionary or in the
+    Prometheus text format.
+'''
+
+import sys
+import time
+import bisect
+import threading
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        # Seconds from an arbitrary point, never goes backwards
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+    except Exception:
+        # time.clock is the high resolution wall clock on windows
+        monotonic = time.clock if sys.platform == 'win32' else time.time
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+"""
+LatencyStats counts durations into the BUCKETS histogram and keeps
+their sum and maximum. Percentiles are estimated from the buckets.
+"""
+class LatencyStats:
+    def __init__(self):
+        self.counts = [0]*len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    # Upper bound of the bucket holding the q-th quantile
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound,n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return 'n: %i mean: %.2fms p50: <%.2fms p95: <%.2fms max: %.2fms'%(
+            self.count, 1e3*self.mean(), 1e3*self.percentile(0.5),
+            1e3*self.percentile(0.95), 1e3*self.max)
+
+
+# Label values as they appear in the Prometheus text format
+def formatLabels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"'%(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k,v in pairs) + '}'
+
+
+"""
+The Metrics registry holds the counters and LatencyStats of a server,
+each one under a name and a set of labels, e.g.
+metrics.observe('mt_task_seconds', 0.02, command='UPDATE').
+
+Values that already live elsewhere, like the depth of the work queue,
+are read when the metrics are exported: a collector is a function
+returning a list of (name, labels, value), a value being a number or
+a LatencyStats. Counter names end in _total and histogram names in
+_seconds by convention.
+"""
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    # The LatencyStats of a name and labels, created on first use
+    def histogram(self, name, **labels):
+        key = self.key(name, labels)
+        stats = self.histograms.get(key)
+        if stats is None:
+            self.lock.acquire()
+            try:
+                stats = self.histograms.setdefault(key, LatencyStats())
+            finally:
+                self.lock.release()
+        return stats
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).add(seconds)
+
+    def collect(self, collector):
+        self.collectors.append(collector)
+
+    # Every metric as a list of (name, labels, value), sorted by name
+    def items(self):
+        self.lock.acquire()
+        try:
+            items = self.counters.items() + self.histograms.items()
+        finally:
+            self.lock.release()
+        items = [(name, labels, value) for (name,labels),value in items]
+        for collector in self.collectors:
+            try:
+                items.extend((name, tuple(sorted(labels.items())), value) for name,labels,value in collector())
+            except Exception as e:
+                print 'Failed collecting metrics: ',e
+        items.sort(key=lambda item: (item[0], item[1]))
+        return items
+
+    # The metrics as a dictionary of name{labels} to the value, or
+    # to count, mean, p50, p95 and max in seconds for a histogram
+    def snapshot(self):
+        out = {}
+        for name,labels,stats in self.items():
+            if isinstance(stats, LatencyStats):
+                stats = {'count': stats.count, 'mean': stats.mean(), 'p50': stats.percentile(0.5),
+                         'p95': stats.percentile(0.95), 'max': stats.max}
+            out[name + formatLabels(labels)] = stats
+        return out
+
+    # The metrics in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        typed = set()
+        for name,labels,stats in self.items():
+            if isinstance(stats, LatencyStats):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram'%(name))
+                seen = 0
+                for bound,n in zip(BUCKETS, stats.counts):
+                    seen += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %i'%(name, formatLabels(labels, [('le', le)]), seen))
+                lines.append('%s_sum%s %r'%(name, formatLabels(labels), stats.total))
+                lines.append('%s_count%s %i'%(name, formatLabels(labels), stats.count))
+            else:
+                if name not in typed:
+                    lines.append('# TYPE %s %s'%(name, 'counter' if name.endswith('_total') else 'gauge'))
+                lines.append('%s%s %r'%(name, formatLabels(labels), stats))
+            typed.add(name)
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,92 @@
+'''
+    Description:
+    Tracing of the path of each task through the server, for finding
+    out where the time went when a command was slow to take effect:
+    reading it from the client, waiting in the work queue, the call to
+    the Comm class, encoding the state and sending it to every client.
+
+    Tracing is off unless turned on with TRACE ON on the console or -t.
+    The events go to a ring buffer of the last TRACE_SIZE events and
+    TRACE DUMP <file> writes them in the Chrome trace format, which
+    chrome://tracing and https://ui.perfetto.dev open. Each thread is a
+    track, the life of every task from its enqueue to its end is an
+    async track of its own with its wait in the queue nested in it.
+'''
+
+import json
+import threading
+import collections
+import itertools
+
+import MTStats
+
+# Number of events kept, the oldest ones are dropped first
+TRACE_SIZE = 100000
+
+
+"""
+The Tracer records spans of time on the thread they happen in and
+async spans, begun and ended on any thread, that belong to a task id.
+Recording is a single append to a deque, the call sites check enabled
+first so that tracing costs nothing while it is off.
+"""
+class Tracer:
+    def __init__(self, size=None):
+        self.enabled = False
+        self.events = collections.deque(maxlen=size or TRACE_SIZE)
+        self.ids = itertools.count(1)
+        self.origin = MTStats.monotonic()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def clear(self):
+        self.events.clear()
+
+    def newId(self):
+        return next(self.ids)
+
+    # A span from start to end, monotonic times, on the current thread
+    def complete(self, name, start, end, cat='server', **args):
+        self.events.append(('X', name, cat, start, end - start, threading.current_thread().name, None, args))
+
+    # The start and end of an async span of a task, matched by name and id
+    def begin(self, name, id, when, cat='task', **args):
+        self.events.append(('b', name, cat, when, 0, threading.current_thread().name, id, args))
+
+    def end(self, name, id, when, cat='task', **args):
+        self.events.append(('e', name, cat, when, 0, threading.current_thread().name, id, args))
+
+    # The events in the Chrome trace format, times in microseconds
+    # from the creation of the tracer and a track for each thread
+    def chromeTrace(self):
+        tids = {}
+        events = []
+        for ph,name,cat,when,duration,thread,id,args in list(self.events):
+            if thread not in tids:
+                tids[thread] = len(tids) + 1
+            event = {'ph': ph, 'name': name, 'cat': cat, 'pid': 1, 'tid': tids[thread],
+                     'ts': 1e6*(when - self.origin), 'args': args}
+            if ph == 'X':
+                event['dur'] = 1e6*duration
+            else:
+                event['id'] = id
+            events.append(event)
+        for thread,tid in tids.items():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    # Writes the events to a file, returns the number written
+    def dump(self, path):
+        trace = self.chromeTrace()
+        f = open(path, 'w')
+        try:
+            json.dump(trace, f, default=str)
+        finally:
+            f.close()
+        return len(trace['traceEvents'])
+
+
+# The tracer of the process, shared by the server, the worker and the
+# protocol as the rest of their state is
+tracer = Tracer()
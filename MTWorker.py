@@ -17,13 +17,43 @@ import select
 import sys
 import threading
 import Queue
+import collections
 import copy
 import time
 import errno
 import os
 import traceback
+
+import MTQueue
+import MTStats
+import MTDispatch
+import MTProfile
+from MTTrace import tracer
+
 DEBUG = False
 
+# Tasks that only read the device and publish the result, any number
+# of them waiting in the work queue is worth a single execution
+IDEMPOTENT_TASKS = ['UPDATE', 'PUPDATE']
+
+# Long reads, served after the commands of the clients
+READ_TASKS = ['SPECIALREQUEST', 'PLOT', 'METHODSAVAILABLE']
+
+# Tasks handled by the worker itself rather than by the Comm class
+WORKER_TASKS = ['METHODSAVAILABLE', 'BATCH', 'UPDATEINTERVAL', 'PUPDATE', 'PLOT', 'SPECIALREQUEST']
+
+# Longest single sleep of the Updater in seconds, how long it takes
+# at most to notice a new interval or to stop
+MAX_SLEEP = 0.1
+
+# Interval in seconds UPDATE and the other polled methods slow down to
+# while no client is watching
+IDLE_INTERVAL = 10.0
+
+# A method is polled at most once every BACKOFF_FACTOR times the
+# time it takes, so that the device and its bus are never saturated
+BACKOFF_FACTOR = 1.5
+
 
 
 """
@@ -44,6 +74,40 @@ Any additional methods can be defined as well as any
 necessary data fields. The access will be thread-safe
 as long as all the methods are only called from the 
 default ones and not directly by the server.
+
+A Comm class can declare COLLAPSIBLE, a dictionary of its setpoint
+methods with the positions of the arguments that select what is set,
+e.g. {'CURRENT': (0,), 'BAxialCurrentLim': ()} for CURRENT(channel,value).
+A newer command for the same method and target replaces one still
+waiting in the work queue, so only the last setpoint is sent.
+
+A Comm class can also declare POLL_INTERVALS, a dictionary of methods
+that the Updater calls periodically besides UPDATE with their interval
+in seconds, e.g. {'GETPMT': 0.1, 'OvenState': 5.0}. Like UPDATE they
+publish the state and are polling tasks in the work queue. The command
+UPDATEINTERVAL <seconds> [<method>] changes the interval of UPDATE or
+of one of these methods, sent by a client it only holds while the
+client is connected and the fastest rate asked for wins, see Updater.
+
+Query methods of the Comm class can be declared in CACHEABLE with the
+age in seconds up to which their result can be reused, e.g.
+{'POWER': 0.2}. Calling one of them again within that time, from a
+client or from UPDATE, returns the remembered result without talking
+to the device. Any other command clears the cache, unless the Comm
+class lists in CACHE_INVALIDATES the cached methods it affects, e.g.
+{'WAVELENGTH': ['POWER']}. See ReadCache.
+
+The server broadcasts the state at most every MIN_PUBLISH_INTERVAL, a
+burst of commands ends in a single broadcast of the final state. The
+commands a Comm class lists in URGENT, e.g. ['OFF', 'STOP'], have the
+state broadcast right away.
+
+The public methods of the Comm class are looked up once when it is
+loaded, the arguments of a command are converted to the types its
+docstring declares, e.g. "inputs: channel [int], value [float]", before
+the method is called. A command with arguments that do not convert is
+refused. METHODSAVAILABLE is answered with the list computed at load
+time, see MTDispatch.
 """
 
 
@@ -51,23 +115,40 @@ default ones and not directly by the server.
 class Worker(threading.Thread):
     def __init__(self, server,workerName):
 
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='Worker')
         
         self.server = server
-        self.workQueue = Queue.Queue(maxsize=0)
         self.running = 1
         self.quitting = 0
 
+        # The task being processed, replies are routed with it
+        self.currentTask = Task("")
+
+        # Time spent processing tasks, for the duty cycle
+        self.started = MTStats.monotonic()
+        self.busyTime = 0.0
+
         ### Device specific setup and data ###
         import importlib 
         self.devicecomm = importlib.import_module('DeviceWorkers.twins.%sComm'%(workerName)).Comm()
-        self.availablecommands = dir(self.devicecomm)
+        self.collapsible = getattr(self.devicecomm, 'COLLAPSIBLE', {})
+        self.pollIntervals = getattr(self.devicecomm, 'POLL_INTERVALS', {})
+        self.urgent = frozenset(getattr(self.devicecomm, 'URGENT', ()))
+        self.pollTasks = IDEMPOTENT_TASKS + list(self.pollIntervals)
+        self.cache = ReadCache(self.devicecomm, getattr(self.devicecomm, 'CACHEABLE', {}),
+                               getattr(self.devicecomm, 'CACHE_INVALIDATES', {}), self.pollTasks)
+        # The methods of the Comm by name and id, with the types
+        # of their arguments, see MTDispatch
+        self.commandTable = MTDispatch.CommandTable(self.devicecomm)
+        # Records the I/O with the device once attached, see MTProfile
+        self.profiler = MTProfile.DeviceProfiler(self.devicecomm)
+        self.workQueue = MTQueue.WorkQueue(self.coalesceKey, self.taskPriority, self.collapseKey)
         
         self.DEFAULT_UPDATE_INTERVAL = 1 # in sec
 
         ######################################
 
-        self.updater = Updater(self, self.DEFAULT_UPDATE_INTERVAL)
+        self.updater = Updater(self, self.DEFAULT_UPDATE_INTERVAL, self.pollIntervals)
         self.updater.start()
         
     # Main worker loop, blocks until there is a task
@@ -75,9 +156,39 @@ class Worker(threading.Thread):
     def run(self):
         while self.running == 1:
             task = self.workQueue.get()
-            self.processTask(task)
+            self.currentTask = task
+            start = MTStats.monotonic()
+            if task.command is not None:
+                self.processCommand(task)
+            else:
+                self.processTask(task.text)
+            duration = MTStats.monotonic() - start
+            self.busyTime += duration
+            name = self.metricName(task)
+            self.server.metrics.observe('mt_task_seconds', duration, command=name)
+            if task.traceId is not None:
+                tracer.complete(name, start, start + duration, 'worker', task=task.traceId)
+                tracer.end(task.traceName, task.traceId, start + duration)
+            if task.priority == MTQueue.POLL:
+                self.updater.pollDone(task.text, duration)
             self.workQueue.task_done()
 
+    # Name of a task in the metrics, PLOT and SPECIALREQUEST without their
+    # suffix and the unknown commands together so the names stay few
+    def metricName(self, task):
+        name = task.text.split(' ', 1)[0]
+        if name in self.commandTable.byName or name in WORKER_TASKS:
+            return name
+        for prefix in ('PLOT', 'SPECIALREQUEST'):
+            if name.startswith(prefix):
+                return prefix
+        return 'unknown'
+
+    # Fraction of the time since the start spent processing tasks
+    def dutyCycle(self):
+        elapsed = MTStats.monotonic() - self.started
+        return self.busyTime / elapsed if elapsed > 0 else 0.0
+
     # Describes how a particular device should react
     # to incoming messages.
     #
@@ -86,25 +197,34 @@ class Worker(threading.Thread):
     def processTask(self,task):
         task = task.rstrip()
         if len(task) <= 3:
+            self.sendError(task, 'task not recognized')
             return
         taskArray = task.split(" ")
         taskType = taskArray[0]
         taskArgs = taskArray[1:]
         if DEBUG: print taskType,taskArgs
+        command = self.commandTable.byName.get(taskType)
         try:
-            if taskType in self.availablecommands or taskType == "":
-                #Check if task is available in comm class
-                #If available, get handle for method and call with passed args
-                getattr(self.devicecomm,taskType)(*taskArgs)
-                self.sendStatusUpdate()
-            elif taskType == "METHODSAVAILABLE":
-                self.sendStatusUpdate(getattr(self.devicecomm,taskType)(*taskArgs), "METHODS")
+            if taskType == "METHODSAVAILABLE":
+                self.sendStatusUpdate(self.commandTable.methods, "METHODS")
+            elif taskType == "BATCH":
+                #Format BATCH CURRENT 1 0.5;CURRENT 2 0.7;ON 1
+                self.processBatch(" ".join(taskArgs))
+            elif command is not None:
+                #Call the method of the comm class with the
+                #arguments converted to their declared types
+                self.cache.invalidate(taskType)
+                result = self.call(command, command.convert(taskArgs))
+                if self.currentTask.reqid is not None:
+                    self.sendStatusUpdate(result, taskType)
+                self.sendStatusUpdate(urgent=taskType in self.urgent)
             elif taskType == "UPDATEINTERVAL":
                 try:          
-                    self.updater.changeTimeInterval(float(taskArgs[0]))
+                    self.updater.changeTimeInterval(float(taskArgs[0]), *taskArgs[1:2], client=self.currentTask.client)
                 except Exception as e:
                     print 'Error when changing update interval: ', e
                     print traceback.format_exc()
+                    self.sendError(taskType, e)
             elif taskType == 'PUPDATE':
                 print "STATUS " + str(time.time()) 
                 for key in self.devicecomm.internal_state:
@@ -117,26 +237,111 @@ class Worker(threading.Thread):
                 #Format SPECIALREQUEST UPDATE;READ;OVEN 1.1;CURRLIM 5.1
                 #etc..
                 try:
-                    specstring = "".join(taskArgs)
+                    specstring = " ".join(taskArgs)
                     specialtasks = specstring.split(';')
                     reqData = {}
                     for req in specialtasks:
                         reqArray = req.split(" ")
                         reqType = reqArray[0]
                         reqArgs = reqArray[1:]
-                        reqData[reqType] = getattr(self.devicecomm,reqType)(*reqArgs)
+                        command = self.commandTable.byName[reqType]
+                        self.cache.invalidate(reqType)
+                        reqData[reqType] = self.call(command, command.convert(reqArgs))
                     
                     self.sendStatusUpdate(reqData, taskType)
                 except Exception as e:
                     print 'Error in processing special task',e
                     print traceback.format_exc()
+                    self.sendError(taskType, e)
             else:
                 print "Task not recognized: (" + task + ")"
                 print "taskType: ("+taskType+")"
-                print "Available commands (%s)"%(str(self.availablecommands))
+                print "Available commands (%s)"%(str(sorted(self.commandTable.byName)))
+                self.sendError(taskType, 'unknown command %s'%(taskType))
         except Exception as e:
             print 'Failed in processTask: ',e
             print traceback.format_exc()
+            self.sendError(taskType, e)
+
+    # A tagged request that failed gets the error as its reply,
+    # the client would otherwise wait for it forever
+    def sendError(self, taskType, e):
+        if self.currentTask.reqid is not None:
+            self.server.sendReply(self.currentTask.client, taskType, {'error': str(e)}, self.currentTask.reqid)
+
+    # Calls a method of the Comm class, traced as a call to the device
+    # and with its I/O attributed to it by the profiler
+    def call(self, command, args):
+        profiler = self.profiler
+        if not tracer.enabled and not profiler.attached:
+            return command.method(*args)
+        start = MTStats.monotonic()
+        profiler.begin(command.name)
+        try:
+            return command.method(*args)
+        finally:
+            profiler.end()
+            if tracer.enabled:
+                tracer.complete('call ' + command.name, start, MTStats.monotonic(), 'device')
+
+    # Runs the commands of a BATCH back to back, no other task gets in
+    # between, and publishes the state once at the end. None of them is
+    # run if one is unknown or its arguments do not convert, the batch
+    # stops at the first one that fails. The requester gets the result
+    # and the time in seconds of each command that ran
+    def processBatch(self, batch):
+        calls = []
+        for text in batch.split(';'):
+            callArray = text.split()
+            if not callArray:
+                continue
+            command = self.commandTable.byName.get(callArray[0])
+            try:
+                if command is None:
+                    raise ValueError('unknown command %s'%(callArray[0]))
+                calls.append((command, command.convert(callArray[1:])))
+            except ValueError as e:
+                self.sendBatchResults([{'command': callArray[0], 'error': str(e)}])
+                return
+
+        results = []
+        for command,args in calls:
+            start = MTStats.monotonic()
+            try:
+                self.cache.invalidate(command.name)
+                result = self.call(command, args)
+                results.append({'command': command.name, 'result': result,
+                                'time': MTStats.monotonic() - start})
+            except Exception as e:
+                print 'Failed in BATCH %s: '%(command.name),e
+                print traceback.format_exc()
+                results.append({'command': command.name, 'error': str(e),
+                                'time': MTStats.monotonic() - start})
+                break
+        self.sendBatchResults(results)
+        self.sendStatusUpdate(urgent=any(command.name in self.urgent for command,args in calls))
+
+    # The results of a BATCH go back to the client that sent it,
+    # tagged with its request id if it had one
+    def sendBatchResults(self, results):
+        if self.currentTask.client is not None:
+            self.server.sendReply(self.currentTask.client, 'BATCH', results, self.currentTask.reqid)
+        else:
+            self.sendStatusUpdate(results, 'BATCH')
+
+    # Calls the method of a command received as a binary frame, its
+    # arguments are already decoded, see MTDispatch
+    def processCommand(self, task):
+        try:
+            self.cache.invalidate(task.text)
+            result = self.call(task.command, task.args)
+            if task.reqid is not None:
+                self.sendStatusUpdate(result, task.text)
+            self.sendStatusUpdate(urgent=task.text in self.urgent)
+        except Exception as e:
+            print 'Failed in processCommand: ',e
+            print traceback.format_exc()
+            self.sendError(task.text, e)
 
     # Encodes the UPDATE message to be distributed to the clients
     # This can be a readout from the device or any other kind of 
@@ -144,74 +349,283 @@ class Worker(threading.Thread):
     #
     # Each message should be of the form:
     # STATUS <ARG1> <ARG2> ...
-    def sendStatusUpdate(self,DATA = None,HEADER = None):
+    #
+    # The device state is published to all clients, any other data
+    # is a reply that only goes back to the client that asked for it
+    # if the task carried a request id. An urgent state is not held
+    # back by the rate limit of the server
+    def sendStatusUpdate(self,DATA = None,HEADER = None,urgent = False):
         ### Define the arguments to send ########
         
         #########################################
 
-        if DATA == None and HEADER == None:
-            message = "STATUS " + str(time.time()) + " "+str(self.devicecomm.internal_state)
+        if DATA is None and HEADER is None:
+            self.server.publishState(self.devicecomm.internal_state, urgent)
+        elif self.currentTask.reqid is not None:
+            self.server.sendReply(self.currentTask.client, str(HEADER), DATA, self.currentTask.reqid)
+        else:
+            self.server.broadcastData(str(HEADER), DATA)
+
+
+    # Key under which identical idempotent tasks are collapsed in the
+    # work queue. Tasks tagged with a request id are never collapsed,
+    # each of them owes its client a reply
+    def coalesceKey(self, task):
+        if task.reqid is not None:
+            return None
+        taskType = task.text.split(' ', 1)[0]
+        if taskType in self.pollTasks or taskType.startswith('PLOT'):
+            return task.text.rstrip()
+        return None
+
+    # Key under which setpoint commands declared in the COLLAPSIBLE of
+    # the Comm class replace each other in the work queue: the method
+    # and the arguments that select the target. Tagged tasks are never
+    # replaced, each of them owes its client a reply
+    def collapseKey(self, task):
+        if task.reqid is not None:
+            return None
+        if task.command is not None:
+            taskArray = [task.text] + list(task.args)
         else:
-            message = str(HEADER)+" " + str(time.time()) + " "+ str(DATA)
-        self.server.broadcastMessage(message)
+            taskArray = task.text.split()
+        if not taskArray or taskArray[0] not in self.collapsible:
+            return None
+        target = self.collapsible[taskArray[0]]
+        taskArgs = taskArray[1:]
+        if len(taskArgs) <= max(target or (-1,)):
+            return None
+        return (taskArray[0],) + tuple(taskArgs[i] for i in target)
 
+    # Priority class of a task in the work queue: commands that change
+    # the device go first, then long reads, then the periodic polling
+    def taskPriority(self, task):
+        taskType = task.text.split(' ', 1)[0]
+        if taskType in self.pollTasks:
+            return MTQueue.POLL
+        for readType in READ_TASKS:
+            if taskType.startswith(readType):
+                return MTQueue.READ
+        return MTQueue.COMMAND
 
     # Adds a task to the worker's workQueue. Can be called by the 
-    # server or directly from the Worker thread
-    def acceptTask(self, task):
-        self.workQueue.put(task)
+    # server or directly from the Worker thread. Blocks the client
+    # thread while the client has too many tasks waiting
+    def acceptTask(self, task, client=None, reqid=None):
+        self.workQueue.put(Task(task, client, reqid))
+
+    # Adds the tasks of a client in one go, a list of (text, reqid)
+    # or of (name, reqid, command, args) for binary commands
+    def acceptTasks(self, tasks, client=None):
+        self.workQueue.putAll([Task(task[0], client, *task[1:]) for task in tasks])
+
+    # Called by a client that disconnects, see WorkQueue.release
+    def releaseClient(self, client):
+        self.workQueue.release(client)
+        self.updater.releaseClient(client)
 
 
     def kill(self):
         self.running = 0
-        self.workQueue.put("STOP") 
+        self.acceptTask("STOP") 
         
         self.updater.kill() 
         self.updater.join() 
 
 
+"""
+A Task is a line of text for the worker together with the client
+it came from and the request id the client tagged it with, if any.
+A binary command carries the Command of MTDispatch to call and its
+decoded arguments, its text is only the name of the method
+"""
+class Task:
+    def __init__(self, text, client=None, reqid=None, command=None, args=None):
+        self.text = text
+        self.client = client
+        self.reqid = reqid
+        self.command = command
+        self.args = args
+
+
+"""
+The ReadCache remembers the results of the query methods a Comm class
+declares in CACHEABLE, by method and arguments, for the number of
+seconds given there. The methods are replaced on the Comm instance, so
+calls made by the Comm class itself, e.g. from UPDATE, are cached too.
+
+invalidate is called with every other command before it is executed,
+the cached methods it lists in invalidates are cleared, all of them if
+it is not listed. Reads, the polling tasks, leave the cache alone.
+"""
+class ReadCache:
+    def __init__(self, devicecomm, cacheable, invalidates, reads):
+        self.maxAge = dict(cacheable)
+        self.invalidates = invalidates
+        self.reads = reads
+        self.entries = {}
+
+        self.hits = collections.defaultdict(int)
+        self.misses = collections.defaultdict(int)
+
+        for name in self.maxAge:
+            setattr(devicecomm, name, self.cached(name, getattr(devicecomm, name)))
+
+    def cached(self, name, method):
+        def call(*args):
+            key = (name,) + args
+            try:
+                entry = self.entries.get(key)
+            except TypeError:
+                return method(*args)
+            now = MTStats.monotonic()
+            if entry is not None and now - entry[1] <= self.maxAge[name]:
+                self.hits[name] += 1
+                return entry[0]
+            self.misses[name] += 1
+            result = method(*args)
+            # Aged from the start of the read, the value may have
+            # changed while the device was answering
+            self.entries[key] = (result, now)
+            return result
+        call.__name__ = method.__name__
+        call.__doc__ = method.__doc__
+        return call
+
+    def invalidate(self, taskType):
+        if taskType in self.maxAge or taskType in self.reads or not self.entries:
+            return
+        names = self.invalidates.get(taskType)
+        if names is None:
+            self.entries.clear()
+        else:
+            for key in [k for k in self.entries if k[0] in names]:
+                del self.entries[key]
+
+    # Fraction of the calls of a method answered from the cache
+    def hitRate(self, name):
+        calls = self.hits[name] + self.misses[name]
+        return float(self.hits[name]) / calls if calls else 0.0
+
+
 """
 The Updater class implements a simple timer which
 forces the Worker to send a status update to all
-clients at predetermined points in time
+clients at predetermined points in time.
+
+Each polled method is due one interval after its previous poll was
+due, on the monotonic clock, so the time the device takes to answer
+does not add up and intervals can be any fraction of a second. UPDATE
+is polled every timeInterval seconds, pollIntervals adds other methods
+of the Comm class with their own interval, see Worker. How late each
+poll was sent is kept in jitter.
+
+The interval actually used follows the demand:
+- with no client watching, connected and subscribed to at least one
+  key of the state, at most every IDLE_INTERVAL
+- otherwise at the fastest rate a watching client asked for with
+  UPDATEINTERVAL, the clients that did not ask get timeInterval
+- never faster than BACKOFF_FACTOR times the time the poll takes
 """
 class Updater(threading.Thread):
-    def __init__(self, worker, timeInterval):
-        threading.Thread.__init__(self)
+    def __init__(self, worker, timeInterval, pollIntervals={}):
+        threading.Thread.__init__(self, name='Updater')
         self.worker = worker
         self.timeInterval = timeInterval
 
-        self.changeTimeQueue = Queue.Queue(maxsize=0)
-        
+        self.intervals = dict(pollIntervals)
+        self.intervals['UPDATE'] = timeInterval
+        self.requests = dict((name, {}) for name in self.intervals)
+        self.durations = dict((name, 0.0) for name in self.intervals)
+        self.jitter = dict((name, MTStats.LatencyStats()) for name in self.intervals)
+        self.last = {}
+        self.lock = threading.Lock()
 
         self.running = 1
 
-    # If there is no waiting time interval change request,
-    # send an UPDATE message to the worker and waits for
-    # a period of time set in self.timeInterval (in seconds)
+    # Sleeps until the earliest deadline, at most MAX_SLEEP at a time
+    # to follow changes of the demand, then sends the method that is
+    # due to the worker
     def run(self):
+        now = MTStats.monotonic()
+        self.lock.acquire()
+        for name in self.intervals:
+            self.last[name] = now
+        self.lock.release()
+
         while self.running == 1:
-            if self.timeInterval > 1: # if interval is large, we still want to respond to external updates
-                for i in range(int(self.timeInterval)):
-                    if not self.changeTimeQueue.empty():
-                        self.timeInterval = self.changeTimeQueue.get()
-                        self.changeTimeQueue.task_done()
-                        if self.timeInterval < i+1:
-                            break
-                    time.sleep(1)
+            self.lock.acquire()
+            due = [(self.last[n] + self.currentInterval(n), n) for n in self.intervals]
+            self.lock.release()
+            deadline,name = min(due)
+
+            now = MTStats.monotonic()
+            if deadline > now:
+                time.sleep(min(deadline - now, MAX_SLEEP))
+                continue
+
+            self.worker.acceptTask(name)
+
+            # A poll more than an interval late was missed, because the
+            # interval just got shorter or the process was suspended
+            self.lock.acquire()
+            if now - deadline < self.currentInterval(name):
+                self.jitter[name].add(now - deadline)
+                self.last[name] = deadline
             else:
-                time.sleep(self.timeInterval)
-                if not self.changeTimeQueue.empty():
-                    self.timeInterval = self.changeTimeQueue.get()
-                    self.changeTimeQueue.task_done()
-            self.worker.acceptTask("UPDATE")
-
-    # Places a request to change the time interval in the
-    # changeTimeQueue. This request will be processed at the
-    # beginning of the next update cycle
-    def changeTimeInterval(self, newTimeInterval):
-        self.changeTimeQueue.put(newTimeInterval)
+                self.last[name] = now
+            self.lock.release()
+
+    # The interval to poll a method at right now, called with the lock held
+    def currentInterval(self, name):
+        requests = self.requests[name]
+        watchers = self.worker.server.watchers()
+        if watchers:
+            interval = min(requests.get(client, self.intervals[name]) for client in watchers)
+        else:
+            interval = max(self.intervals[name], IDLE_INTERVAL)
+        return max(interval, BACKOFF_FACTOR * self.durations[name])
+
+    # Called by the worker with the time a poll took, smoothed
+    # so that a single slow answer does not slow down polling
+    def pollDone(self, name, duration):
+        if name in self.durations:
+            self.durations[name] += 0.25 * (duration - self.durations[name])
+
+    # Changes the interval of UPDATE or of another polled method.
+    # An interval asked for by a client only holds while it is
+    # connected, the one from the console is the default and can
+    # start polling another method of the Comm class
+    def changeTimeInterval(self, newTimeInterval, name='UPDATE', client=None):
+        if newTimeInterval <= 0:
+            raise ValueError('the update interval must be positive')
+        self.lock.acquire()
+        try:
+            if client is not None:
+                if name not in self.intervals:
+                    raise ValueError('%s is not polled'%(name))
+                self.requests[name][client] = newTimeInterval
+            else:
+                if name not in self.intervals:
+                    if name not in self.worker.commandTable.byName:
+                        raise ValueError('%s is not a method of the device'%(name))
+                    self.worker.pollTasks.append(name)
+                    self.requests[name] = {}
+                    self.durations[name] = 0.0
+                    self.jitter[name] = MTStats.LatencyStats()
+                    self.last[name] = MTStats.monotonic() - newTimeInterval
+                self.intervals[name] = newTimeInterval
+                if name == 'UPDATE':
+                    self.timeInterval = newTimeInterval
+        finally:
+            self.lock.release()
+
+    # Forgets the intervals a client asked for once it disconnects
+    def releaseClient(self, client):
+        self.lock.acquire()
+        for requests in self.requests.itervalues():
+            requests.pop(client, None)
+        self.lock.release()
 
     def kill(self):
         self.running = 0
-    
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+'''
+    Description:
+    Benchmarks for the server side of MTserver. A stand-in worker replaces
+    the device worker so that only the networking is measured, and a set of
+    local clients reads the length-prefixed messages the server sends out.
+
+    connect   : time for a burst of clients to connect and receive their
+                initial status message
+    broadcast : time for a series of status broadcasts to reach every client
+
+    Each benchmark is run against the threaded Server and the EventServer.
+
+    publish   : rate of state updates the worker reaches, with each device
+                read taking DEVICE_TIME, and the fraction of its time spent
+                on the device, with the broadcasts done by the worker
+                itself and by the publisher thread
+
+    framing   : time and bytes copied to frame a broadcast for all clients,
+                once per client as the server used to and once for all
+
+    commands  : rate at which the LineFramer splits commands, and at which
+                commands sent by a client reach the worker. Before that
+                the framer is fuzzed with lines cut at random points,
+                a failed trial makes the benchmark exit with status 1.
+                With -x only the fuzzing is run, as a check
+
+    burst     : state broadcasts each client receives for a burst of
+                state changes, with and without MIN_PUBLISH_INTERVAL
+
+    dispatch  : rate at which setpoint commands are parsed and their
+                method called, from text lines as Worker.processTask
+                does and from binary frames through the command table
+
+    Usage: python MTbench.py [-c CLIENTS] [-n BROADCASTS] [-s SIZE] [-k KEYS] [-t MS] [-f TRIALS] [-x]
+'''
+
+import socket
+import select
+import sys
+import threading
+import time
+import struct
+import os
+import argparse
+import random
+
+import MTserver
+import MTProtocol
+import MTQueue
+import MTWorker
+import MTDispatch
+
+PAYLOAD_SIZE = 1024
+
+# Keys of the state published by the BenchWorker and time in
+# seconds each simulated device read takes
+STATE_KEYS = 200
+DEVICE_TIME = 0.002
+
+
+"""
+The BenchWorker takes the place of the Worker, every task it
+receives is answered with a broadcast of PAYLOAD_SIZE bytes. The
+BENCH header is not conflated, so every broadcast reaches every client.
+
+A STATE task instead simulates a device read of DEVICE_TIME that changes
+a tenth of the STATE_KEYS keys, then publishes the state. The time spent
+reading is kept in deviceTime. NOP tasks are only counted
+"""
+class BenchWorker(threading.Thread):
+    def __init__(self, server, workerName):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.server = server
+        self.workQueue = MTQueue.WorkQueue()
+        self.running = 1
+        self.quitting = 0
+
+        self.state = dict(('KEY%i'%(i), 0.0) for i in range(STATE_KEYS))
+        self.reads = 0
+        self.deviceTime = 0.0
+        self.nops = 0
+
+    def run(self):
+        while self.running == 1:
+            task = self.workQueue.get()
+            if task.text == "STATE":
+                self.readDevice()
+                self.server.publishState(self.state)
+            elif task.text.startswith("NOP"):
+                self.nops += 1
+            elif task.text != "STOP":
+                self.server.broadcastMessage("BENCH " + str(time.time()) + " " + "x"*PAYLOAD_SIZE)
+            self.workQueue.task_done()
+
+    def readDevice(self):
+        start = time.time()
+        time.sleep(DEVICE_TIME)
+        self.reads += 1
+        for i in range(self.reads % 10, STATE_KEYS, 10):
+            self.state['KEY%i'%(i)] = float(self.reads)
+        self.deviceTime += time.time() - start
+
+    def acceptTask(self, task, client=None, reqid=None):
+        self.workQueue.put(MTWorker.Task(task, client, reqid))
+
+    def acceptTasks(self, tasks, client=None):
+        self.workQueue.putAll([MTWorker.Task(task[0], client, *task[1:]) for task in tasks])
+
+    def releaseClient(self, client):
+        self.workQueue.release(client)
+
+    def kill(self):
+        self.running = 0
+        self.acceptTask("STOP")
+
+
+"""
+The BenchClients open a number of connections to the server and
+count the complete messages received on each of them
+"""
+class BenchClients:
+    def __init__(self, port):
+        self.port = port
+        self.socks = []
+        self.buffers = {}
+        self.received = {}
+
+    def connect(self, num):
+        for i in range(num):
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            self.socks.append(sock)
+            self.buffers[sock] = ''
+            self.received[sock] = 0
+
+    # Read from all connections until each of them has
+    # received at least count messages in total
+    def waitFor(self, count, timeout=60.0):
+        deadline = time.time() + timeout
+        waiting = [s for s in self.socks if self.received[s] < count]
+        while waiting:
+            if time.time() > deadline:
+                raise RuntimeError("timed out waiting for %i messages"%(count))
+            readable,writable,exceptional = select.select(waiting,[],[],1.0)
+            for sock in readable:
+                self.read(sock)
+            waiting = [s for s in waiting if self.received[s] < count]
+
+    # Read and discard everything until the server has been
+    # quiet for a while, then restart counting from zero.
+    # Returns the number of messages received in total
+    def drain(self, quiet=0.2):
+        readable = self.socks
+        while readable:
+            readable,writable,exceptional = select.select(self.socks,[],[],quiet)
+            for sock in readable:
+                self.read(sock)
+        total = sum(self.received.values())
+        for sock in self.socks:
+            self.received[sock] = 0
+        return total
+
+    def read(self, sock):
+        data = self.buffers[sock] + sock.recv(1 << 16)
+        offset = 0
+        while len(data) - offset >= 4:
+            length = struct.unpack('>I', data[offset:offset+4])[0]
+            if len(data) - offset - 4 < length:
+                break
+            offset += 4 + length
+            self.received[sock] += 1
+        self.buffers[sock] = data[offset:]
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+        self.socks = []
+
+
+"""
+The BenchComm stands for a Comm class with a single setpoint
+"""
+class BenchComm:
+    def __init__(self):
+        self.internal_state = {'CURRENT': 0.0}
+
+    def SetCurrent(self, value):
+        '''inputs: value [float]'''
+        self.internal_state['CURRENT'] = float(value)
+
+
+def startServer(serverClass, port):
+    MTserver.Worker = BenchWorker
+    server = serverClass("BenchWorker", port)
+    server.host = '127.0.0.1'
+    server.console = None
+
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    while not server.worker.isAlive():
+        time.sleep(0.01)
+    return server, thread
+
+
+def stopServer(server, thread):
+    server.running = 0
+    # Wake up the main loop with a throw-away connection,
+    # unless something else woke it up already
+    try:
+        socket.create_connection(('127.0.0.1', server.port)).close()
+    except socket.error:
+        pass
+    thread.join(10.0)
+
+
+def benchmark(serverClass, port, clients, broadcasts):
+    # Nothing may be dropped for the counts to add up
+    MTserver.SEND_QUEUE_SIZE = broadcasts + clients + 1
+    server, thread = startServer(serverClass, port)
+    bench = BenchClients(server.port)
+
+    start = time.time()
+    bench.connect(clients)
+    bench.waitFor(1)
+    connectTime = time.time() - start
+    threads = threading.activeCount()
+
+    # Every new client triggers an update for all of them
+    bench.drain()
+
+    start = time.time()
+    for i in range(broadcasts):
+        server.getWorker().acceptTask("UPDATE")
+    bench.waitFor(broadcasts)
+    broadcastTime = time.time() - start
+
+    bench.close()
+    stopServer(server, thread)
+    return connectTime, broadcastTime, threads
+
+
+# Frames a broadcast of size bytes for a number of clients, the old
+# way with the length prefix added for each client and once for all
+# of them. Returns the time per broadcast of both and the bytes copied
+def benchmarkFraming(size, clients, repeat=20):
+    payload = 'x'*size
+
+    start = time.time()
+    for i in range(repeat):
+        msg = MTProtocol.encodeRepr('READOUT', 0.0, payload)
+        frames = [struct.pack('>I', len(msg)) + msg for c in range(clients)]
+    perClient = (time.time() - start) / repeat
+
+    start = time.time()
+    for i in range(repeat):
+        message = MTProtocol.Message('READOUT', 0.0, payload)
+        frames = [message.frame() for c in range(clients)]
+    shared = (time.time() - start) / repeat
+
+    length = len(frames[0])
+    return perClient, shared, clients*length, length
+
+
+# Feeds random lines to a LineFramer cut into pieces at random points,
+# from single bytes to many lines at once. Every line up to maxLength
+# must come out whole and in order and every longer one be dropped.
+# Returns the number of failed trials
+def fuzzFramer(trials, maxLength=1000, seed=0):
+    rng = random.Random(seed)
+    alphabet = 'abcXYZ019 .;@_-\t'
+    failures = 0
+    for trial in range(trials):
+        lines = []
+        data = []
+        for i in range(rng.randint(0, 50)):
+            line = ''.join(rng.choice(alphabet) for c in range(rng.choice([1, rng.randint(1, 40), rng.randint(1, 2*maxLength)])))
+            ending = rng.choice(['\n', '\r\n'])
+            if len(line) + len(ending) - 1 <= maxLength:
+                lines.append(line)
+            data.append(line + ending)
+        data = ''.join(data)
+
+        framer = MTProtocol.LineFramer(maxLength)
+        received = []
+        offset = 0
+        while offset < len(data):
+            step = rng.choice([1, rng.randint(1, 16), rng.randint(1, 4*maxLength)])
+            received.extend(framer.feed(data[offset:offset+step]))
+            offset += step
+        if received != lines:
+            failures += 1
+    return failures
+
+
+# Commands per second split by the LineFramer from RECV_SIZE pieces
+def benchmarkFramer(commands):
+    data = ''.join('NOP %i\n'%(i) for i in range(commands))
+    framer = MTProtocol.LineFramer()
+    count = 0
+    start = time.time()
+    for offset in range(0, len(data), MTserver.RECV_SIZE):
+        count += len(framer.feed(data[offset:offset+MTserver.RECV_SIZE]))
+    return count / (time.time() - start)
+
+
+# Commands per second from a client socket to the worker
+def benchmarkCommands(serverClass, port, commands):
+    server, thread = startServer(serverClass, port)
+    worker = server.getWorker()
+    sock = socket.create_connection(('127.0.0.1', server.port))
+    time.sleep(0.2)
+
+    data = ''.join('NOP %i\n'%(i) for i in range(commands))
+    start = time.time()
+    sock.sendall(data)
+    deadline = start + 60.0
+    while worker.nops < commands and time.time() < deadline:
+        time.sleep(0.001)
+    rate = worker.nops / (time.time() - start)
+
+    sock.close()
+    stopServer(server, thread)
+    return rate
+
+
+# State broadcasts received by each client for a burst of updates
+# and the time until the last one arrived
+def benchmarkBurst(serverClass, port, clients, updates, interval):
+    MTserver.MIN_PUBLISH_INTERVAL = interval
+    server, thread = startServer(serverClass, port)
+    bench = BenchClients(server.port)
+    bench.connect(clients)
+    bench.waitFor(1)
+    bench.drain()
+
+    worker = server.getWorker()
+    start = time.time()
+    for i in range(updates):
+        worker.acceptTask("STATE")
+    worker.workQueue.join()
+    received = bench.drain(quiet=interval + 0.2)
+
+    bench.close()
+    stopServer(server, thread)
+    return received / float(clients), time.time() - start
+
+
+# Setpoint commands per second parsed and dispatched, from text lines
+# and from binary frames, both split from RECV_SIZE pieces
+def benchmarkDispatch(commands):
+    comm = BenchComm()
+    table = MTDispatch.CommandTable(comm)
+    data = ''.join('SetCurrent %.4f\n'%(i*1e-3) for i in range(commands))
+    framer = MTProtocol.LineFramer()
+    start = time.time()
+    for offset in range(0, len(data), MTserver.RECV_SIZE):
+        for line in framer.feed(data[offset:offset+MTserver.RECV_SIZE]):
+            taskArray = line.rstrip().split(" ")
+            command = table.byName.get(taskArray[0])
+            if command is not None:
+                command.method(*command.convert(taskArray[1:]))
+    text = commands / (time.time() - start)
+
+    command = table.byName['SetCurrent']
+    data = ''.join(MTProtocol.frame(MTDispatch.HEADER.pack(command.id, 0) + struct.pack('>d', i*1e-3))
+                   for i in range(commands))
+    reader = MTProtocol.FrameReader()
+    start = time.time()
+    for offset in range(0, len(data), MTserver.RECV_SIZE):
+        for frame in reader.feed(data[offset:offset+MTserver.RECV_SIZE]):
+            command, args, reqid = table.decode(frame)
+            command.method(*args)
+    binary = commands / (time.time() - start)
+    return text, binary
+
+
+# The clients take turns at receiving the full state, deltas and
+# a tenth of the keys, they do not read during the measurement
+def benchmarkPublish(serverClass, port, clients, updates, publisherThread):
+    MTserver.PUBLISHER_THREAD = publisherThread
+    MTserver.MIN_PUBLISH_INTERVAL = 0.0
+    server, thread = startServer(serverClass, port)
+    bench = BenchClients(server.port)
+    bench.connect(clients)
+    bench.waitFor(1)
+    for i,sock in enumerate(bench.socks):
+        if i % 3 == 1:
+            sock.sendall("DELTA ON\n")
+        elif i % 3 == 2:
+            sock.sendall("SUBSCRIBE KEY1?\n")
+    bench.drain()
+
+    worker = server.getWorker()
+    worker.deviceTime = 0.0
+    start = time.time()
+    for i in range(updates):
+        worker.acceptTask("STATE")
+    worker.workQueue.join()
+    elapsed = time.time() - start
+    duty = worker.deviceTime / elapsed
+
+    bench.close()
+    stopServer(server, thread)
+    return updates / elapsed, duty
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the threaded and the event loop server")
+
+    parser.add_argument("-c", "--clients", default=100, type=int, help="number of connected clients")
+    parser.add_argument("-n", "--broadcasts", default=200, type=int, help="number of status broadcasts")
+    parser.add_argument("-s", "--size", default=1024, type=int, help="size of each status message in bytes")
+    parser.add_argument("-k", "--keys", default=200, type=int, help="number of keys in the published state")
+    parser.add_argument("-t", "--device-time", default=2.0, type=float, help="time of a simulated device read in ms")
+    parser.add_argument("-f", "--fuzz", default=200, type=int, help="number of fuzzing trials of the line framer")
+    parser.add_argument("-p", "--port", default=12400, type=int, help="first port to run the servers on")
+    parser.add_argument("-x", "--check", action="store_true", help="only fuzz the line framer, exit with status 1 if a trial failed")
+
+    args = vars(parser.parse_args(sys.argv[1:]))
+    PAYLOAD_SIZE = args["size"]
+    STATE_KEYS = args["keys"]
+    DEVICE_TIME = args["device_time"] * 1e-3
+
+    if args["check"]:
+        failures = fuzzFramer(args["fuzz"])
+        print "line framer fuzzing: %i of %i trials failed"%(failures,args["fuzz"])
+        sys.exit(1 if failures else 0)
+
+    # The servers are chatty about every connection
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    out.write("%i clients, %i broadcasts of %i bytes\n\n"%(args["clients"],args["broadcasts"],PAYLOAD_SIZE))
+    out.write("%-12s %12s %14s %14s %8s\n"%("server","connect [s]","broadcast [s]","messages/s","threads"))
+    port = args["port"]
+    for name,serverClass in [("threaded",MTserver.Server),("eventloop",MTserver.EventServer)]:
+        connectTime, broadcastTime, threads = benchmark(serverClass, port, args["clients"], args["broadcasts"])
+        rate = args["clients"]*args["broadcasts"]/broadcastTime
+        out.write("%-12s %12.4f %14.4f %14.0f %8i\n"%(name,connectTime,broadcastTime,rate,threads))
+        port += 10
+
+    out.write("\n%i clients, %i state updates of %i keys, %.1fms per device read\n\n"%(args["clients"],args["broadcasts"],STATE_KEYS,1e3*DEVICE_TIME))
+    out.write("%-12s %-12s %12s %16s\n"%("server","publishing","updates/s","device duty [%]"))
+    for name,serverClass in [("threaded",MTserver.Server),("eventloop",MTserver.EventServer)]:
+        for publishing,publisherThread in [("worker",False),("publisher",True)]:
+            rate, duty = benchmarkPublish(serverClass, port, args["clients"], args["broadcasts"], publisherThread)
+            out.write("%-12s %-12s %12.0f %16.0f\n"%(name,publishing,rate,100*duty))
+            port += 10
+
+    out.write("\n%i clients, burst of 50 state updates\n\n"%(args["clients"]))
+    out.write("%-12s %14s %20s\n"%("server","interval [s]","broadcasts/client"))
+    for name,serverClass in [("threaded",MTserver.Server),("eventloop",MTserver.EventServer)]:
+        for interval in [0.0, 0.05]:
+            received, elapsed = benchmarkBurst(serverClass, port, args["clients"], 50, interval)
+            out.write("%-12s %14g %20.1f\n"%(name,interval,received))
+            port += 10
+
+    out.write("\nframing a broadcast for every client\n\n")
+    out.write("%-10s %8s %16s %14s %16s %14s\n"%("size [B]","clients","per client [ms]","copied [B]","shared [ms]","copied [B]"))
+    for size in [1024, 65536, 262144]:
+        for clients in [1, 10, 100]:
+            perClient, shared, copied, copiedShared = benchmarkFraming(size, clients)
+            out.write("%-10i %8i %16.3f %14i %16.3f %14i\n"%(size,clients,1e3*perClient,copied,1e3*shared,copiedShared))
+
+    failures = fuzzFramer(args["fuzz"])
+    out.write("\nline framer fuzzing: %i of %i trials failed\n"%(failures,args["fuzz"]))
+    commands = 100*args["broadcasts"]
+    out.write("%i commands, framer alone: %.0f commands/s\n\n"%(commands,benchmarkFramer(commands)))
+    out.write("%-12s %12s\n"%("server","commands/s"))
+    for name,serverClass in [("threaded",MTserver.Server),("eventloop",MTserver.EventServer)]:
+        out.write("%-12s %12.0f\n"%(name,benchmarkCommands(serverClass, port, commands)))
+        port += 10
+
+    text, binary = benchmarkDispatch(commands)
+    out.write("\n%i setpoints dispatched, text: %.0f commands/s binary: %.0f commands/s\n"%(commands,text,binary))
+
+    # A framer that garbles commands fails the run whatever the numbers
+    if failures:
+        sys.exit(1)
@@ -16,6 +16,7 @@ import select
 import sys
 import threading
 import Queue
+import collections
 import copy
 import time
 import errno
@@ -26,13 +27,56 @@ import os.path
 import json
 import traceback
 import os
+import fcntl
 import readline
 import rlcompleter
+import fnmatch
+import BaseHTTPServer
+
+import MTProtocol
+import MTQueue
+import MTStats
+from MTTrace import tracer
 
 readline.parse_and_bind('tab: complete')
 
 DEBUG = False
 
+# Number of messages that can wait to be sent to a single client
+# before the oldest ones are dropped
+SEND_QUEUE_SIZE = 100
+
+# Messages with these headers only carry the latest state, a newer
+# one replaces an older one that is still waiting to be sent
+CONFLATE_HEADERS = ['STATUS']
+
+# Encode and queue the broadcasts of the worker in a thread of their
+# own, see Publisher
+PUBLISHER_THREAD = True
+
+# A new client is sent the last published state right away, the
+# device is only read again if that state is older than this, in seconds
+SNAPSHOT_MAX_AGE = 2.0
+
+# Size of the buffer each client connection receives into
+RECV_SIZE = 65536
+
+# Shortest time in seconds between two broadcasts of the state, the
+# states published in between are held back and only the last one
+# is broadcast once the interval is over
+MIN_PUBLISH_INTERVAL = 0.05
+
+# Profile the I/O of the Comm class with the device from the start,
+# see PROFILE on the console and MTProfile
+PROFILE_DEVICE = False
+
+# File TRACE DUMP writes to when no file is given, see MTTrace
+TRACE_FILE = 'mttrace.json'
+
+# Port of the HTTP server exporting the metrics in the Prometheus text
+# format, None for no HTTP server
+METRICS_PORT = None
+
 try:
     DICT_FILE = os.environ['DEV_DICT']
     print 'Loading device dictionary : %s'%DICT_FILE
@@ -69,14 +113,52 @@ class Server:
 
             self.server = None
             self.threads = []
+
+            # Counters and latencies of the server and of the worker,
+            # see METRICS. The bytes sent to clients that are gone
+            self.metrics = MTStats.Metrics()
+            self.metrics.collect(self.collectMetrics)
+            self.metricsServer = None
+            self.closedBytesSent = 0
+
             print 'The worker name is : %s'%(workerName)
             self.worker = Worker(self,string.split(workerName,'Worker')[0])
+            if PROFILE_DEVICE:
+                self.worker.profiler.attach()
             self.workerName = workerName
 
             # self.f = file("messageLog.txt", "w")
 
             self.deadThreads = []
             self.serverLock = threading.Lock()
+
+            self.console = sys.stdin
+            self.running = 1
+
+            # Last published state, used to find the keys that changed
+            # and sent to new clients, with the monotonic time it was
+            # published at. The lock keeps a new client from receiving
+            # it after a newer one
+            self.lastState = None
+            self.lastKeyframe = 0
+            self.lastSnapshot = None
+            self.lastPublished = 0
+            self.publishLock = threading.Lock()
+
+            # State held back by the rate limit, the timer that will
+            # publish it and the number of states it replaced
+            self.nextPublish = 0
+            self.heldState = None
+            self.flushTimer = None
+            self.throttled = 0
+            self.throttleLock = threading.Lock()
+
+            # Keys of internal_state matched by each set of subscription
+            # patterns, rebuilt when the keys of internal_state change
+            self.stateKeys = frozenset()
+            self.subscriptionIndex = {}
+
+            self.publisher = Publisher() if PUBLISHER_THREAD else None
         except Exception as e:
             print "Error: %s" %(str(e))
             print traceback.format_exc()
@@ -87,7 +169,7 @@ class Server:
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             
             self.server.bind((self.host,self.port))
-            self.server.listen(5)
+            self.server.listen(socket.SOMAXCONN)
 
             print "Server accepting connections on %s ip:%s port: %s"%(self.hostname,self.host,str(self.port))
 
@@ -103,25 +185,270 @@ class Server:
     def getWorker(self):
         return self.worker
 
+    # Hands the work of a broadcast to the publisher thread, so the
+    # worker can go on with the device while the clients are served.
+    # Without it the broadcast is done right away by the caller.
+    # A latest broadcast replaces the previous one if still waiting
+    def publish(self, func, args, latest=False):
+        if self.publisher is not None:
+            self.publisher.put(func, args, latest)
+        else:
+            func(*args)
+
     # TODO: Make sure that nothing can destroy/remove a thread while
     # a long message is being broadcast, is it OK to block the server
     # while sending? -> Probably OK, other thread will allocate memory
     # for the function call and the message won't get lost
     def broadcastMessage(self, message):
+        self.publish(self.fanOutMessage, (message,))
+
+    def fanOutMessage(self, message):
         # self.serverLock.acquire()
         #threads = copy.copy(self.threads)
         
         # self.f.write(message)
 
-        for thread in self.threads:
-            thread.sendMessage(message)
+        start = MTStats.monotonic()
+        header = message.split(' ', 1)[0]
+        key = header if header in CONFLATE_HEADERS else None
+        message = MTProtocol.frame(message)
+
+        for thread in list(self.threads):
+            thread.sendMessage(message, key)
         
         threadNum = len(self.threads)
+        end = MTStats.monotonic()
+        self.metrics.observe('mt_broadcast_seconds', end - start, type='message')
+        if tracer.enabled:
+            tracer.complete('fan out ' + header, start, end, clients=threadNum)
 
         # self.serverLock.release()    
 
+        self.wakeup()
         self.debugMsg("Broadcasting a message to all users: NUM = " + str(threadNum))
 
+    # Send a reply of the worker to all clients, each in its own encoding.
+    # The data is copied like the state, the worker may change it
+    def broadcastData(self, header, data):
+        data = MTProtocol.copyState(data)
+        self.publish(self.fanOutData, (MTProtocol.Message(header, time.time(), data),))
+
+    def fanOutData(self, message):
+        start = MTStats.monotonic()
+        for thread in list(self.threads):
+            thread.sendData(message)
+        end = MTStats.monotonic()
+        self.metrics.observe('mt_broadcast_seconds', end - start, type='data')
+        if tracer.enabled:
+            tracer.complete('fan out ' + message.header, start, end, clients=len(self.threads))
+
+        self.wakeup()
+        self.debugMsg("Broadcasting %s to all users: NUM = %i"%(message.header,len(self.threads)))
+
+    # Send a reply of the worker only to the client that asked for it
+    def sendReply(self, client, header, data, reqid):
+        if client is None or not client.running:
+            return
+        data = MTProtocol.copyState(data)
+        self.publish(self.fanOutReply, (client, MTProtocol.Message(header, time.time(), data, reqid)))
+
+    def fanOutReply(self, client, message):
+        if not client.running:
+            return
+        start = MTStats.monotonic()
+        client.sendData(message)
+        if tracer.enabled:
+            tracer.complete('reply ' + message.header, start, MTStats.monotonic(), reqid=message.reqid)
+
+        self.wakeup()
+        self.debugMsg("Replying %s to %s"%(message.header,str(client.address)))
+
+    # Send the device state to all clients, as a full STATUS or as a
+    # DELTA of the keys that changed depending on the client. Every
+    # KEYFRAME_INTERVAL seconds all clients get the full state.
+    # The worker only copies the state, down to its nested values
+    # since it keeps changing them, the publisher compares it
+    # with the previous one, encodes it and queues it for the clients.
+    # States are broadcast at most every MIN_PUBLISH_INTERVAL, one
+    # published sooner is held back until the interval is over and
+    # replaced by any newer one. An urgent state goes out right away
+    def publishState(self, state, urgent=False):
+        args = (MTProtocol.copyState(state), time.time())
+        self.throttleLock.acquire()
+        try:
+            now = MTStats.monotonic()
+            if urgent or now >= self.nextPublish:
+                self.heldState = None
+                self.nextPublish = now + MIN_PUBLISH_INTERVAL
+                self.publish(self.fanOutState, args, True)
+                return
+            if self.heldState is None:
+                self.flushTimer = threading.Timer(self.nextPublish - now, self.flushState)
+                self.flushTimer.daemon = True
+                self.flushTimer.start()
+            else:
+                self.throttled += 1
+            self.heldState = args
+        finally:
+            self.throttleLock.release()
+
+    # Publishes the state held back by publishState, if any
+    def flushState(self):
+        self.throttleLock.acquire()
+        try:
+            if self.heldState is not None:
+                self.nextPublish = MTStats.monotonic() + MIN_PUBLISH_INTERVAL
+                self.publish(self.fanOutState, self.heldState, True)
+                self.heldState = None
+        finally:
+            self.throttleLock.release()
+
+    def fanOutState(self, state, now):
+        start = MTStats.monotonic()
+        snapshot = MTProtocol.Snapshot(state, self.lastState, now)
+        keyframe = snapshot.keyframe or now - self.lastKeyframe >= MTProtocol.KEYFRAME_INTERVAL
+        if keyframe:
+            self.lastKeyframe = now
+        if snapshot.keyframe:
+            keys = frozenset(snapshot.state)
+            if keys != self.stateKeys:
+                self.stateKeys = keys
+                self.subscriptionIndex = {}
+
+        self.publishLock.acquire()
+        try:
+            for thread in list(self.threads):
+                thread.sendState(snapshot, keyframe)
+            self.lastState = snapshot.state
+            self.lastSnapshot = snapshot
+            self.lastPublished = MTStats.monotonic()
+        finally:
+            self.publishLock.release()
+        self.metrics.observe('mt_broadcast_seconds', self.lastPublished - start, type='state')
+        if tracer.enabled:
+            tracer.complete('fan out STATUS', start, self.lastPublished, clients=len(self.threads),
+                            changed=len(snapshot.changed))
+
+        self.wakeup()
+        self.debugMsg("Publishing state to all users: NUM = " + str(len(self.threads)))
+
+    # Send the last published state to a client that just connected,
+    # and have the device read if there is none or if it is too old
+    def welcome(self, client):
+        self.publishLock.acquire()
+        try:
+            snapshot = self.lastSnapshot
+            if snapshot is not None:
+                client.sendState(snapshot, True)
+            fresh = snapshot is not None and MTStats.monotonic() - self.lastPublished <= SNAPSHOT_MAX_AGE
+        finally:
+            self.publishLock.release()
+
+        if snapshot is not None:
+            self.wakeup()
+        if not fresh:
+            self.getWorker().acceptTask("UPDATE")
+
+    # Called once messages have been queued for the clients
+    def wakeup(self):
+        pass
+
+    # The clients that receive the state, connected and subscribed
+    # to at least one of its keys, as sendState decides
+    def watchers(self):
+        return [c for c in list(self.threads) if c.running and self.subscribedKeys(c.subscription) != frozenset()]
+
+    # Returns the keys of internal_state matching a set of
+    # subscription patterns, or None for a client that never
+    # subscribed and receives everything. Also called by the Updater,
+    # the index may be replaced by the publisher meanwhile
+    def subscribedKeys(self, patterns):
+        if patterns is None:
+            return None
+        index = self.subscriptionIndex
+        if patterns not in index:
+            keys = set()
+            for pattern in patterns:
+                keys.update(fnmatch.filter(self.stateKeys, pattern))
+            index[patterns] = frozenset(keys)
+        return index[patterns]
+
+    # Handles the commands that configure the connection of a client
+    # instead of being passed to the worker. Returns True if the line
+    # was such a command
+    def processClientCommand(self, client, line):
+        taskArray = line.split()
+        if not taskArray:
+            return False
+        if taskArray[0] == 'DELTA' and len(taskArray) == 2:
+            client.delta = taskArray[1] == 'ON'
+            client.needsKeyframe = True
+            return True
+        if taskArray[0] == 'ENCODING' and len(taskArray) == 2:
+            if taskArray[1] in MTProtocol.ENCODERS:
+                client.setEncoding(taskArray[1])
+                self.wakeup()
+            else:
+                print "Unknown encoding requested by %s: %s"%(str(client.address),taskArray[1])
+            return True
+        if taskArray[0] == 'SUBSCRIBE' and len(taskArray) > 1:
+            client.subscribe(taskArray[1:])
+            return True
+        if taskArray[0] == 'UNSUBSCRIBE':
+            client.unsubscribe(taskArray[1:])
+            return True
+        if taskArray[0] == 'COMMANDS' and len(taskArray) == 1:
+            client.sendData(MTProtocol.Message('COMMANDS', time.time(), self.worker.commandTable.describe()))
+            self.wakeup()
+            return True
+        if taskArray[0] == 'METRICS' and len(taskArray) == 1:
+            client.sendData(MTProtocol.Message('METRICS', time.time(), self.metrics.snapshot()))
+            self.wakeup()
+            return True
+        return False
+
+    # The metrics read from the state of the server and the worker
+    # when they are exported, see MTStats.Metrics
+    def collectMetrics(self):
+        items = [('mt_clients', {}, len(self.threads)),
+                 ('mt_states_throttled_total', {}, self.throttled)]
+        sent = self.closedBytesSent
+        for client in list(self.threads):
+            name = '%s:%s'%(client.address[0],client.address[1])
+            items.append(('mt_client_backlog', {'client': name}, len(client.sendQueue)))
+            items.append(('mt_client_sent_bytes_total', {'client': name}, client.bytesSent))
+            items.append(('mt_client_dropped_total', {'client': name}, client.sendQueue.dropped))
+            sent += client.bytesSent
+        items.append(('mt_sent_bytes_total', {}, sent))
+        for encoding,stats in MTProtocol.encodeTimes.items():
+            items.append(('mt_encode_seconds', {'encoding': encoding}, stats))
+        if self.publisher is not None:
+            items.append(('mt_publisher_backlog', {}, len(self.publisher)))
+            items.append(('mt_publisher_conflated_total', {}, self.publisher.conflated))
+            items.append(('mt_publish_latency_seconds', {}, self.publisher.latency))
+
+        workQueue = self.worker.workQueue
+        for priority,name in enumerate(MTQueue.PRIORITY_NAMES):
+            items.append(('mt_queue_depth', {'priority': name}, len(workQueue.classes[priority])))
+            items.append(('mt_queue_wait_seconds', {'priority': name}, workQueue.waitTimes[priority]))
+        for taskType,count in workQueue.coalesced.items():
+            items.append(('mt_coalesced_total', {'command': taskType}, count))
+        for taskType,count in workQueue.collapsed.items():
+            items.append(('mt_collapsed_total', {'command': taskType}, count))
+        items.append(('mt_worker_duty', {}, self.worker.dutyCycle()))
+        cache = self.worker.cache
+        for name in cache.maxAge:
+            items.append(('mt_cache_hits_total', {'method': name}, cache.hits[name]))
+            items.append(('mt_cache_misses_total', {'method': name}, cache.misses[name]))
+        for name,stats in self.worker.updater.jitter.items():
+            items.append(('mt_poll_late_seconds', {'method': name}, stats))
+        for key,stats in self.worker.profiler.commands.items():
+            items.append(('mt_device_roundtrip_seconds', {'command': key}, stats.roundTrip))
+            items.append(('mt_device_sleep_seconds_total', {'command': key}, stats.sleep))
+            items.append(('mt_device_sent_bytes_total', {'command': key}, stats.bytesOut))
+            items.append(('mt_device_received_bytes_total', {'command': key}, stats.bytesIn))
+        return items
+
     def removeClient(self, clientThread):
         self.serverLock.acquire()
 
@@ -135,17 +462,19 @@ class Server:
 
     def run(self):
         self.openSocket()
+        self.startPublisher()
+        self.startMetrics()
         self.worker.start()
 
-        inputSources = [self.server,sys.stdin]
-        running = 1
+        inputSources = [self.server]
+        if self.console:
+            inputSources.append(self.console)
 
         print "Launching console for " + self.workerName + "...\n"
         print "Enter HELP for a list of commands"
 
-        while running and not self.worker.quitting:
-            sys.stdout.write(self.workerName + "> ")
-            sys.stdout.flush()
+        while self.running and not self.worker.quitting:
+            self.prompt()
 
             inputready,outputready,exceptready = select.select(inputSources,[],[])
 
@@ -157,12 +486,15 @@ class Server:
 
                     clientThread = ClientThread(client, self)
                     print "Client connected:" + str(clientThread.address)
-                    clientThread.start()
 
+                    # Registered before it starts, a client that disconnects
+                    # right away removes itself from the list
                     self.serverLock.acquire()
                     self.threads.append(clientThread)
                     self.serverLock.release()
 
+                    clientThread.start()
+
 
                     # Process zombie clients:
                     self.serverLock.acquire()
@@ -176,40 +508,14 @@ class Server:
 
                     self.serverLock.release()
 
-                elif s == sys.stdin:
-                    text = sys.stdin.readline().rstrip()
-                    try:
-                        if text == 'HELP':
-                            print "The available commands are: \n\tHELP \n\tSTATUS \n\tDEVICESTATUS \n\tKILL"
-                        elif text == 'STATUS':
-                            print "Server running on ip: %s port: %s"%(self.host,str(self.port))
-                            print "Current number of connected clients: " + str(len(self.threads))
-                            for i in self.threads:
-                                print '\tClient: %s @%s:%i\n'%(socket.gethostbyaddr(i.address[0])[0],i.address[0],i.address[1])
-                        elif text == 'DEVICESTATUS':
-                            print "Current Device state: "
-                            self.worker.acceptTask('PUPDATE')
-                        elif 'CMD' in text:
-                            cmd = text.split('CMD ')[1]
-                            print 'Processing command %s \n'%cmd
-                            self.worker.acceptTask(cmd)
-                        elif text == "":
-                            print ''
-                        elif text == 'KILL':
-                            running = 0
-                        else:
-                            print "Command not recognized, enter HELP to see the list of available commands."
-                    except Exception as e:
-                        print 'terminal cmd error: \n',e
-                        pass
-
-                    
+                elif s == self.console:
+                    self.processConsoleCommand(self.console.readline().rstrip())
 
         # Shut down all sockets
         print "Shutting down..."
         self.server.close()
         print "Server socket closed"
-        KillList = self.threads
+        KillList = list(self.threads)
         for thread in KillList:
             thread.kill()
             thread.join()
@@ -219,11 +525,148 @@ class Server:
 
         self.worker.kill()
         self.worker.join()
+        self.stopPublisher()
+        self.stopMetrics()
 
         # self.f.close()
 
         print "Everything is dead"
 
+    def startPublisher(self):
+        if self.publisher is not None:
+            self.publisher.start()
+
+    # Serves the metrics over HTTP on METRICS_PORT, if set
+    def startMetrics(self):
+        if METRICS_PORT is None:
+            return
+        try:
+            self.metricsServer = MetricsServer(('', METRICS_PORT), self.metrics)
+        except socket.error, e:
+            print "ERROR: Could not serve the metrics on port %i: %s"%(METRICS_PORT,str(e))
+            return
+        thread = threading.Thread(target=self.metricsServer.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print "Serving metrics at http://%s:%i/metrics"%(self.hostname,METRICS_PORT)
+
+    def stopMetrics(self):
+        if self.metricsServer is not None:
+            self.metricsServer.shutdown()
+            self.metricsServer.server_close()
+
+    def stopPublisher(self):
+        if self.flushTimer is not None:
+            self.flushTimer.cancel()
+        self.flushState()
+        if self.publisher is not None:
+            self.publisher.kill()
+            self.publisher.join()
+
+    # TRACE ON|OFF|CLEAR|DUMP [<file>] typed into the console
+    def processTraceCommand(self, args):
+        if args == ['ON']:
+            tracer.enable(True)
+            print "Tracing into a ring buffer of the last %i events"%(tracer.events.maxlen)
+        elif args == ['OFF']:
+            tracer.enable(False)
+        elif args == ['CLEAR']:
+            tracer.clear()
+        elif args and args[0] == 'DUMP' and len(args) <= 2:
+            path = args[1] if len(args) == 2 else TRACE_FILE
+            print "Wrote %i trace events to %s"%(tracer.dump(path),path)
+        else:
+            print "Tracing is %s, %i events recorded"%('on' if tracer.enabled else 'off',len(tracer.events))
+
+    # PROFILE [ON|OFF|CLEAR] typed into the console, without
+    # arguments it prints the device commands, slowest first
+    def processProfileCommand(self, args):
+        profiler = self.worker.profiler
+        if args == ['ON']:
+            profiler.attach()
+        elif args == ['OFF']:
+            profiler.detach()
+        elif args == ['CLEAR']:
+            profiler.clear()
+        else:
+            print "Device profiling is %s"%('on' if profiler.attached else 'off')
+            print profiler.report()
+
+    def prompt(self):
+        if self.console:
+            sys.stdout.write(self.workerName + "> ")
+            sys.stdout.flush()
+
+    # Handles a single line typed into the server console,
+    # KILL clears self.running which ends the main loop
+    def processConsoleCommand(self, text):
+        try:
+            if text == 'HELP':
+                print "The available commands are: \n\tHELP \n\tSTATUS \n\tMETRICS \n\tDEVICESTATUS \n\tWEIGHT <ip>:<port> <n> \n\tTRACE ON|OFF|CLEAR|DUMP [<file>] \n\tPROFILE [ON|OFF|CLEAR] \n\tKILL"
+            elif text == 'METRICS':
+                sys.stdout.write(self.metrics.prometheus())
+            elif text.startswith('TRACE'):
+                self.processTraceCommand(text.split()[1:])
+            elif text.startswith('PROFILE'):
+                self.processProfileCommand(text.split()[1:])
+            elif text == 'STATUS':
+                print "Server running on ip: %s port: %s"%(self.host,str(self.port))
+                print "Current number of connected clients: " + str(len(self.threads))
+                if self.lastSnapshot is not None:
+                    print "State last published %.1fs ago"%(MTStats.monotonic() - self.lastPublished)
+                print "States held back by the rate limit of %gs: %i"%(MIN_PUBLISH_INTERVAL,self.throttled)
+                workQueue = self.worker.workQueue
+                print "Tasks waiting for the worker: %i"%(workQueue.qsize())
+                for taskType,count in sorted(workQueue.coalesced.items()):
+                    print '\tcoalesced %s: %i'%(taskType,count)
+                for taskType,count in sorted(workQueue.collapsed.items()):
+                    print '\tcollapsed %s: %i'%(taskType,count)
+                for priority,name in enumerate(MTQueue.PRIORITY_NAMES):
+                    print '\t%-8s waiting: %i wait time %s'%(name,len(workQueue.classes[priority]),workQueue.waitTimes[priority].summary())
+                print "Worker busy %.0f%% of the time"%(100*self.worker.dutyCycle())
+                if self.publisher is not None:
+                    publisher = self.publisher
+                    print "Broadcasts waiting for the publisher: %i, conflated: %i"%(len(publisher),publisher.conflated)
+                    print "\tpublished %s"%(publisher.latency.summary())
+                cache = self.worker.cache
+                for name,maxAge in sorted(cache.maxAge.items()):
+                    print '\tcached %s for %gs, hits: %i misses: %i (%.0f%%)'%(name,maxAge,cache.hits[name],cache.misses[name],100*cache.hitRate(name))
+                updater = self.worker.updater
+                for name,interval in sorted(updater.intervals.items()):
+                    print '\tpolling %s every %.3gs (default %gs), late by %s'%(name,updater.currentInterval(name),interval,updater.jitter[name].summary())
+                for i in self.threads:
+                    print '\tClient: %s @%s:%i'%(socket.gethostbyaddr(i.address[0])[0],i.address[0],i.address[1])
+                    q = i.sendQueue
+                    print '\t\tmode: %s encoding: %s'%('DELTA' if i.delta else 'STATUS',i.encoding)
+                    print '\t\ttasks waiting: %i weight: %i'%(workQueue.depth(i),workQueue.weights.get(i,1))
+                    if i.subscription is not None:
+                        print '\t\tsubscribed: %s'%(' '.join(sorted(i.subscription)))
+                    print '\t\tqueued: %i sent: %i conflated: %i dropped: %i\n'%(len(q),q.sent,q.conflated,q.dropped)
+            elif text == 'DEVICESTATUS':
+                print "Current Device state: "
+                self.worker.acceptTask('PUPDATE')
+            elif text.startswith('WEIGHT '):
+                address,weight = text.split()[1:]
+                for i in self.threads:
+                    if '%s:%i'%(i.address[0],i.address[1]) == address:
+                        self.worker.workQueue.setWeight(i, weight)
+                        break
+                else:
+                    print 'No client connected from %s'%(address)
+            elif 'CMD' in text:
+                cmd = text.split('CMD ')[1]
+                print 'Processing command %s \n'%cmd
+                self.worker.acceptTask(cmd)
+            elif text == "":
+                print ''
+            elif text == 'KILL':
+                self.running = 0
+            else:
+                print "Command not recognized, enter HELP to see the list of available commands."
+        except Exception as e:
+            print 'terminal cmd error: \n',e
+            pass
+
     # If the debug flag is set to True, print msg to stdout
     def debugMsg(self, msg):
         if self.debug:
@@ -231,62 +674,313 @@ class Server:
 
 
 """
-The ClientThread implements a connection with a single client
+The EventServer is an alternative to the thread-per-client Server.
+A single event loop owns the listening socket, every client socket
+and the console, so a large number of idle clients costs no threads.
 
-It listens at the assigned socket for incoming messages
-from the client and distributes server broadcasts to them.
+Lines received from the clients are handed to Worker.acceptTask just
+like in the threaded server. Messages broadcast by the Worker are
+queued on each ClientConnection and written out by the event loop
+once the socket is writable, using the same length-prefixed framing.
+"""
+class EventServer(Server):
+    def __init__(self, workerName, port):
+        Server.__init__(self, workerName, port)
+
+        # The worker thread writes to this pipe to wake up the
+        # event loop when there is outgoing data to send. Both ends
+        # are non-blocking, wakeup is called with the work queue lock
+        # held and from the event loop itself, a full pipe already
+        # guarantees that the loop wakes up
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.worker.workQueue.resume = lambda client: self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeWrite, 'x')
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    # Empties the wakeup pipe, however many wakeups are pending
+    def drainWakeup(self):
+        while True:
+            try:
+                if not os.read(self.wakeRead, 4096):
+                    return
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    # Connections have no thread to join, so they are dropped
+    # right away instead of being kept as zombies
+    def removeClient(self, connection):
+        self.serverLock.acquire()
+        self.threads.remove(connection)
+        self.serverLock.release()
+
+        print "Client removed from the list"
+
+    def run(self):
+        self.openSocket()
+        self.server.setblocking(0)
+        self.startPublisher()
+        self.startMetrics()
+        self.worker.start()
+
+        print "Launching console for " + self.workerName + " (event loop)...\n"
+        print "Enter HELP for a list of commands"
+        self.prompt()
+
+        while self.running and not self.worker.quitting:
+            # Clients that sent more than the worker can take are not
+            # read from, the worker wakes the loop up once it caught up
+            backlogged = [c for c in self.threads if c.backlogged()]
+            for c in backlogged:
+                c.forwardLines()
+            backlogged = [c for c in backlogged if c.backlogged()]
+
+            inputSources = [self.server, self.wakeRead] + [c for c in self.threads if c not in backlogged]
+            if self.console:
+                inputSources.append(self.console)
+            outputSources = [c for c in self.threads if c.pendingOutput()]
+
+            try:
+                inputready,outputready,exceptready = select.select(inputSources,outputSources,[])
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+
+            for s in outputready:
+                if s.running:
+                    s.flush()
+
+            for s in inputready:
+                if s == self.server:
+                    self.acceptClients()
+                elif s == self.wakeRead:
+                    self.drainWakeup()
+                elif s == self.console:
+                    self.processConsoleCommand(self.console.readline().rstrip())
+                    self.prompt()
+                elif s.running:
+                    s.receive()
+
+        # Shut down all sockets
+        print "Shutting down..."
+        self.server.close()
+        print "Server socket closed"
+        for connection in list(self.threads):
+            connection.kill()
+
+        self.worker.kill()
+        self.worker.join()
+        self.stopPublisher()
+        self.stopMetrics()
+
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+        print "Everything is dead"
+
+    # Accept every connection waiting on the listening socket,
+    # a connect storm is drained in a single loop iteration
+    def acceptClients(self):
+        while True:
+            try:
+                client = self.server.accept()
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            connection = ClientConnection(client, self)
+            print "Client connected:" + str(connection.address)
 
-By default, the maximum length of a message can be 1024B.
+            self.serverLock.acquire()
+            self.threads.append(connection)
+            self.serverLock.release()
+
+            connection.start()
+
+
+"""
+The ClientBase holds what a connection with a single client needs
+regardless of whether it is served by its own thread or by the
+event loop of the EventServer.
 """
-class ClientThread(threading.Thread):
+class ClientBase:
     def __init__(self,(client,address), server):
-        threading.Thread.__init__(self)
-
         self.debug = DEBUG
 
         self.server = server
         self.client = client
         self.address = address
         self.running = 1
+        self.killLock = threading.Lock()
 
-    # Listen to messages from the client and forward them
-    # to the worker thread when they arrive
-    def run(self):
-        # Force an initial update        
-        self.server.getWorker().acceptTask("UPDATE")
+        self.sendQueue = SendQueue()
 
-        while self.running:
-            data = self.client.recv(8192)
-            if data:
-                self.debugMsg("A client sent data: (" + data + ")")
-
-                # Remove new line at the end of the message
-                data = data.rstrip("\n\r")
-                dataArray = data.split('\n')
-                # TODO: add a filter for server-side tasks
-                # TODO: handle the DISCONNECT message
-                for i in dataArray:
-                    self.server.getWorker().acceptTask(i)
+        # Send only the changed keys instead of the full state
+        self.delta = False
+        self.needsKeyframe = True
+
+        # Encoding of the messages, see MTProtocol. The lock keeps the
+        # messages in order while the encoding is being changed
+        self.encoding = 'REPR'
+        self.sendLock = threading.Lock()
+
+        # Glob patterns over the keys of internal_state this client
+        # receives, None until it subscribes for the first time
+        self.subscription = None
+
+        # Reused for every read from the socket
+        self.recvBuffer = bytearray(RECV_SIZE)
+        self.framer = MTProtocol.LineFramer()
+
+        # Set once the client switched to binary command frames
+        self.commandTable = None
+
+        self.bytesSent = 0
+
+    # Read what the socket has into the receive buffer and return the
+    # complete commands received, None once the client has disconnected.
+    # Lines are returned as they are, binary frames already decoded
+    def readCommands(self):
+        n = self.client.recv_into(self.recvBuffer)
+        if not n:
+            return None
+        start = MTStats.monotonic()
+        dropped = self.framer.dropped
+        if self.commandTable is not None:
+            commands = self.decodeFrames(self.framer.feed(memoryview(self.recvBuffer)[:n]))
+        else:
+            commands = self.framer.feed(memoryview(self.recvBuffer)[:n], 'INPUT BINARY')
+            if commands and commands[-1] == 'INPUT BINARY':
+                commands.pop()
+                rest = self.framer.rest()
+                self.commandTable = self.server.getWorker().commandTable
+                self.framer = MTProtocol.FrameReader()
+                commands.extend(self.decodeFrames(self.framer.feed(rest)))
+        if self.framer.dropped > dropped:
+            print "Dropped a command longer than %i bytes from %s"%(self.framer.maxLength,str(self.address))
+        self.debugMsg("A client sent commands: " + str(commands))
+        if tracer.enabled:
+            tracer.complete('recv', start, MTStats.monotonic(), 'client', bytes=n, commands=len(commands),
+                            client='%s:%s'%(self.address[0],self.address[1]))
+        return commands
 
+    # Binary frames become the tasks of the commands they call,
+    # see MTDispatch. Bad frames are dropped
+    def decodeFrames(self, frames):
+        tasks = []
+        for frame in frames:
+            try:
+                command, args, reqid = self.commandTable.decode(frame)
+            except ValueError as e:
+                print "Bad command frame from %s: %s"%(str(self.address),str(e))
+                continue
+            tasks.append((command.name, reqid, command, args))
+        return tasks
+
+    # Forward the commands received from the client to the worker, in one
+    # batch, except the lines meant for the server itself. A line starting
+    # with @<id> is a request, its replies come back to this client only
+    def processCommands(self, commands):
+        # TODO: handle the DISCONNECT message
+        tasks = []
+        for line in commands:
+            if not isinstance(line, str):
+                tasks.append(line)
+                continue
+            reqid = None
+            if line.startswith('@'):
+                reqid, _, line = line[1:].partition(' ')
+            if not self.server.processClientCommand(self, line):
+                tasks.append((line, reqid))
+        if tasks:
+            start = MTStats.monotonic()
+            self.server.getWorker().acceptTasks(tasks, self)
+            if tracer.enabled:
+                tracer.complete('enqueue', start, MTStats.monotonic(), 'client', tasks=len(tasks),
+                                client='%s:%s'%(self.address[0],self.address[1]))
+
+    # Queue the state of a broadcast in the form this client asked for.
+    # A client in delta mode gets the full state after connecting, on
+    # keyframes and whenever one of its messages had to be dropped.
+    # A client that subscribed to nothing costs nothing
+    def sendState(self, snapshot, keyframe=False):
+        keys = self.server.subscribedKeys(self.subscription)
+        if keys is not None and not keys:
+            return
+        snapshot = snapshot.subset(keys)
+
+        self.sendLock.acquire()
+        try:
+            encoding = self.encoding
+            if self.sendQueue.resync:
+                self.sendQueue.resync = False
+                self.needsKeyframe = True
+
+            if self.delta and not keyframe and not self.needsKeyframe:
+                if snapshot.changed:
+                    self.sendMessage(snapshot.deltaMessage.frame(encoding), 'STATUS', lambda: snapshot.frame(encoding))
             else:
-                self.debugMsg("recv returned null: connection interrupted")
-                self.kill()
-    
-    # Send a given message to the client socket   
-    # Prefixed with message length for unpacking
-    # See http://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data 
-    def sendMessage(self, msg):
+                self.needsKeyframe = False
+                self.sendMessage(snapshot.frame(encoding), 'STATUS')
+        finally:
+            self.sendLock.release()
+
+    # Queue any other message of the worker in this client's encoding
+    def sendData(self, message):
+        self.sendLock.acquire()
         try:
-            msg = struct.pack('>I', len(msg)) + msg
-            self.client.sendall(msg)
+            self.sendMessage(message.frame(self.encoding))
+        finally:
+            self.sendLock.release()
 
-        except socket.error, e:
-            print "ERROR: Socket invalidated while sending"
-            self.kill()
+    # Add glob patterns to the subscription, the next state is sent
+    # in full so that the client has the new keys right away
+    def subscribe(self, patterns):
+        self.subscription = frozenset(self.subscription or ()) | frozenset(patterns)
+        self.needsKeyframe = True
+
+    # Remove patterns from the subscription, or all of them
+    def unsubscribe(self, patterns):
+        if patterns:
+            self.subscription = frozenset(self.subscription or ()) - frozenset(patterns)
+        else:
+            self.subscription = frozenset()
 
+    # Switch to another encoding. Acknowledged with an ENCODING message
+    # in the new encoding, every message after it uses the new encoding
+    # and the next state is sent in full
+    def setEncoding(self, encoding):
+        self.sendLock.acquire()
+        try:
+            self.encoding = encoding
+            self.needsKeyframe = True
+            self.sendQueue.barrier()
+            self.sendMessage(MTProtocol.Message('ENCODING', time.time(), encoding).frame(encoding))
+        finally:
+            self.sendLock.release()
+
+    # Can be called from any thread, only the first call
+    # closes the connection
     def kill(self):
-        if self.running == 1:
-            self.running = 0
+        self.killLock.acquire()
+        alive = self.running == 1
+        self.running = 0
+        self.killLock.release()
+
+        if alive:
+            self.sendQueue.close()
+            self.server.getWorker().releaseClient(self)
+            self.server.closedBytesSent += self.bytesSent
 
             try:
                 self.debugMsg("Killing the client connection")
@@ -311,18 +1005,373 @@ class ClientThread(threading.Thread):
             print msg
 
 
+"""
+The ClientThread implements a connection with a single client
+
+It listens at the assigned socket for incoming messages
+from the client and distributes server broadcasts to them.
+
+A message can be up to MTProtocol.MAX_LINE_LENGTH long.
+"""
+class ClientThread(ClientBase, threading.Thread):
+    def __init__(self,(client,address), server):
+        threading.Thread.__init__(self, name='client %s:%s'%(address[0],address[1]))
+        ClientBase.__init__(self, (client,address), server)
+
+    # Listen to messages from the client and forward them
+    # to the worker thread when they arrive
+    def run(self):
+        self.writer = threading.Thread(target=self.writeLoop, name='send %s:%s'%(self.address[0],self.address[1]))
+        self.writer.daemon = True
+        self.writer.start()
+
+        # Initial state, from the last update if it is recent enough
+        self.server.welcome(self)
+
+        while self.running:
+            try:
+                commands = self.readCommands()
+            except socket.error, e:
+                commands = None
+            if commands is not None:
+                # Blocks while the worker is behind on this client
+                self.processCommands(commands)
+
+            else:
+                self.debugMsg("recv returned null: connection interrupted")
+                self.kill()
+    
+    # Queue a given message for the client, the caller never
+    # blocks on a slow client. Messages with the same key replace
+    # each other while waiting, see SendQueue. The message is a
+    # frame of MTProtocol, shared by all the clients it goes to
+    def sendMessage(self, msg, key=None, full=None):
+        self.sendQueue.put(msg, key, full)
+
+    # Send the queued messages to the client socket
+    # Prefixed with message length for unpacking
+    # See http://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data 
+    def writeLoop(self):
+        while self.running:
+            msg = self.sendQueue.get()
+            if msg is None:
+                break
+            try:
+                start = MTStats.monotonic()
+                self.client.sendall(msg)
+                self.bytesSent += len(msg)
+                if tracer.enabled:
+                    tracer.complete('send', start, MTStats.monotonic(), 'client', bytes=len(msg))
+
+            except socket.error, e:
+                print "ERROR: Socket invalidated while sending"
+                self.kill()
+
+
+"""
+The ClientConnection is the event loop counterpart of the ClientThread.
+
+It never blocks: incoming data is split into lines as it arrives,
+keeping any partial line until the rest of it is received, and
+outgoing messages are queued until the EventServer finds the
+socket writable.
+"""
+class ClientConnection(ClientBase):
+    def __init__(self,(client,address), server):
+        ClientBase.__init__(self, (client,address), server)
+        self.client.setblocking(0)
+
+        self.lines = collections.deque()
+        self.outframe = None
+        self.outOffset = 0
+
+    # Used by select to wait on the client socket directly
+    def fileno(self):
+        return self.client.fileno()
+
+    def start(self):
+        # Initial state, from the last update if it is recent enough
+        self.server.welcome(self)
+
+    # Called by the event loop when the socket is readable
+    def receive(self):
+        try:
+            commands = self.readCommands()
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            commands = None
+
+        if commands is None:
+            self.debugMsg("recv returned null: connection interrupted")
+            self.kill()
+            return
+
+        self.lines.extend(commands)
+        self.forwardLines()
+
+    # Hand the received lines to the worker while it has room for the
+    # tasks of this client, the rest wait here. The event loop stops
+    # reading from the socket until they are all forwarded
+    def forwardLines(self):
+        workQueue = self.server.getWorker().workQueue
+        while self.lines and self.running and not workQueue.full(self):
+            room = MTQueue.MAX_CLIENT_TASKS - workQueue.depth(self)
+            self.processCommands([self.lines.popleft() for i in range(min(room, len(self.lines)))])
+
+    def backlogged(self):
+        return self.running and len(self.lines) > 0
+
+    # Queue a message for the event loop, see SendQueue
+    def sendMessage(self, msg, key=None, full=None):
+        self.sendQueue.put(msg, key, full)
+
+    def pendingOutput(self):
+        return self.running and (self.outframe is not None or len(self.sendQueue) > 0)
+
+    # Called by the event loop when the socket is writable,
+    # writes as much of the queued output as the socket accepts.
+    # The rest of a partly sent frame is passed as a view, so
+    # that a large message is not copied on every write
+    def flush(self):
+        try:
+            while True:
+                if self.outframe is None:
+                    self.outframe = self.sendQueue.get(False)
+                    if self.outframe is None:
+                        return
+                    self.outOffset = 0
+
+                start = MTStats.monotonic()
+                if self.outOffset:
+                    sent = self.client.send(memoryview(self.outframe)[self.outOffset:])
+                else:
+                    sent = self.client.send(self.outframe)
+                self.outOffset += sent
+                self.bytesSent += sent
+                if tracer.enabled:
+                    tracer.complete('send', start, MTStats.monotonic(), 'client', bytes=sent,
+                                    client='%s:%s'%(self.address[0],self.address[1]))
+                if self.outOffset < len(self.outframe):
+                    return
+                self.outframe = None
+
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            print "ERROR: Socket invalidated while sending"
+            self.kill()
+
+
+"""
+The Publisher is the stage between the worker and the clients. The
+worker hands it each broadcast, with the state already copied, and
+goes back to the device while the publisher compares, encodes and
+queues the messages for every client.
+
+Broadcasts are published in the order they were handed over. A state
+handed over while the previous one is still waiting replaces it, the
+clients only need the latest. The time from hand-over to the end of
+the fan-out is kept in latency.
+"""
+class Publisher(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name='Publisher')
+        self.daemon = True
+
+        self.items = collections.deque()
+        self.condition = threading.Condition(threading.Lock())
+        self.running = 1
+
+        self.conflated = 0
+        self.latency = MTStats.LatencyStats()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, func, args, latest=False):
+        self.condition.acquire()
+        try:
+            item = (func, args, MTStats.monotonic(), latest)
+            if latest and self.items and self.items[-1][3] and func == self.items[-1][0]:
+                self.items[-1] = item
+                self.conflated += 1
+            else:
+                self.items.append(item)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while self.running and not self.items:
+                    self.condition.wait()
+                if not self.items:
+                    return
+                func,args,queued,latest = self.items.popleft()
+            finally:
+                self.condition.release()
+
+            try:
+                func(*args)
+            except Exception as e:
+                print 'Failed in publishing: ',e
+                print traceback.format_exc()
+            self.latency.add(MTStats.monotonic() - queued)
+
+    # Stops once everything handed over so far is published
+    def kill(self):
+        self.condition.acquire()
+        self.running = 0
+        self.condition.notifyAll()
+        self.condition.release()
+
+
+"""
+The MetricsServer answers GET /metrics with the metrics of the server
+in the Prometheus text format
+"""
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, metrics):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.metrics = metrics
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not worth a line on the console each
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+The SendQueue holds the messages waiting to be sent to one client.
+
+It is bounded so that a client that stops reading cannot make the
+server run out of memory, the oldest message is dropped when it is
+full. A message put with a key replaces the message with the same
+key that is still waiting, so a slow client skips stale STATUS
+messages and receives only the latest one. When the new message
+only makes sense together with the ones it replaces, like a DELTA,
+full returns the complete message to queue instead.
+"""
+class SendQueue:
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or SEND_QUEUE_SIZE
+        self.items = collections.deque()
+        self.keyed = {}
+        self.condition = threading.Condition(threading.Lock())
+        self.closed = False
+
+        self.sent = 0
+        self.conflated = 0
+        self.dropped = 0
+
+        # Set when a keyed message was dropped
+        self.resync = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, msg, key=None, full=None):
+        self.condition.acquire()
+        try:
+            if self.closed:
+                return
+
+            if key is not None and key in self.keyed:
+                self.keyed[key][1] = full() if full else msg
+                self.conflated += 1
+                return
+
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.discard(dropped)
+                self.dropped += 1
+                if dropped[0] is not None:
+                    self.resync = True
+
+            item = [key, msg]
+            self.items.append(item)
+            if key is not None:
+                self.keyed[key] = item
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    # Returns the next message, None if the queue was closed
+    # or if block is False and there is nothing waiting
+    def get(self, block=True):
+        self.condition.acquire()
+        try:
+            while block and not self.items and not self.closed:
+                self.condition.wait()
+            if self.closed or not self.items:
+                return None
+
+            item = self.items.popleft()
+            self.discard(item)
+            self.sent += 1
+            return item[1]
+        finally:
+            self.condition.release()
+
+    # Messages queued so far are no longer replaced by newer ones
+    def barrier(self):
+        self.condition.acquire()
+        self.keyed.clear()
+        self.condition.release()
+
+    def discard(self, item):
+        if item[0] is not None and self.keyed.get(item[0]) is item:
+            del self.keyed[item[0]]
+
+    def close(self):
+        self.condition.acquire()
+        self.closed = True
+        self.items.clear()
+        self.keyed.clear()
+        self.condition.notifyAll()
+        self.condition.release()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Universal server black-boxing the communication with individual equipment")
 
     parser.add_argument("worker", help="specify the Worker module you want to communicate with")
     parser.add_argument("-p", "--port", default=12345, type=int, help="specify the port at which you want to broadcast")
     parser.add_argument("-d", "--debug", action="store_true", help="enable debug messages")
+    parser.add_argument("-a", "--max-age", default=SNAPSHOT_MAX_AGE, type=float, help="oldest state in seconds sent to a new client without reading the device again")
+    parser.add_argument("-l", "--max-line", default=MTProtocol.MAX_LINE_LENGTH, type=int, help="longest command line in bytes accepted from a client")
+    parser.add_argument("-i", "--publish-interval", default=MIN_PUBLISH_INTERVAL, type=float, help="shortest time in seconds between two broadcasts of the state")
+    parser.add_argument("-m", "--metrics-port", default=METRICS_PORT, type=int, help="port of an HTTP server exporting the metrics for Prometheus")
+    parser.add_argument("-t", "--trace", action="store_true", help="trace every task from the start, see TRACE on the console")
+    parser.add_argument("-P", "--profile", action="store_true", help="profile the I/O with the device from the start, see PROFILE on the console")
+    parser.add_argument("-e", "--eventloop", action="store_true", help="serve all clients from a single event loop instead of one thread per client")
 
     args = vars(parser.parse_args(sys.argv[1:]))
 
     import importlib
     Worker = importlib.import_module("MTWorker").Worker
     DEBUG = args["debug"]
+    SNAPSHOT_MAX_AGE = args["max_age"]
+    MIN_PUBLISH_INTERVAL = args["publish_interval"]
+    METRICS_PORT = args["metrics_port"]
+    tracer.enable(args["trace"])
+    PROFILE_DEVICE = args["profile"]
+    MTProtocol.MAX_LINE_LENGTH = args["max_line"]
 
     try:
         import procname
@@ -330,5 +1379,8 @@ if __name__ == "__main__":
     except:
         print "Procname module not found. Using default procname: python"
 
-    server = Server(args["worker"], args["port"])
+    if args["eventloop"]:
+        server = EventServer(args["worker"], args["port"])
+    else:
+        server = Server(args["worker"], args["port"])
     server.run()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+    Description:
+    Runs MTserver for a SampleWorker against the simulated instruments of
+    SimulatedDevices instead of the hardware, for trying out a worker or
+    load testing the server on a machine without the instruments.
+
+    The simulations are started and the constants of the Comm module
+    pointed at them before MTserver starts the worker: AgilentBO gets a
+    TCP server on localhost, Keithley a pty as its serial port. Newport,
+    WaveMeter, Camera and PowerMeter find their libraries and modules
+    simulated by install(). The Comm modules are taken from SampleWorkers
+    when there is no DeviceWorkers package.
+
+    FunctionGenerator33220A is not simulated, its Comm module does not
+    compile and never opens the serial port it writes to. The
+    Agilent33220A of Instruments is there for when it does.
+
+    Every command to the instruments takes LATENCY ms plus up to JITTER
+    ms more and fails with a probability of FAILURE. The commands sent
+    and the failures are printed when the server quits.
+
+    Usage: python MTsimulate.py <worker> [--latency MS] [--jitter MS] [--failure P] [--seed N] [MTserver options]
+'''
+
+import sys
+import os
+import imp
+import runpy
+import argparse
+import importlib
+
+import SimulatedDevices
+from SimulatedDevices.SCPI import TCPServer, SerialPort
+from SimulatedDevices.Instruments import N6700B, Keithley2400
+
+SAMPLE_WORKERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SampleWorkers')
+
+# The SCPI instruments served to the workers, with their transport.
+# The other workers only need install()
+INSTRUMENTS = {'AgilentBO': (N6700B, TCPServer),
+               'Keithley': (Keithley2400, SerialPort)}
+LIBRARY_WORKERS = ['Newport', 'WaveMeter', 'Camera', 'PowerMeter']
+
+
+# Makes DeviceWorkers.twins, where MTWorker imports the Comm modules
+# from, the SampleWorkers if it does not exist
+def useSampleWorkers():
+    try:
+        importlib.import_module('DeviceWorkers.twins')
+    except ImportError:
+        package = imp.new_module('DeviceWorkers')
+        package.__path__ = []
+        twins = imp.new_module('DeviceWorkers.twins')
+        twins.__path__ = [SAMPLE_WORKERS]
+        package.twins = twins
+        sys.modules['DeviceWorkers'] = package
+        sys.modules['DeviceWorkers.twins'] = twins
+
+
+# Starts the simulation of a worker and points its Comm module at it
+def simulate(worker, faults):
+    SimulatedDevices.install(faults, camera=worker == 'Camera')
+    useSampleWorkers()
+    if worker in INSTRUMENTS:
+        instrument,transport = INSTRUMENTS[worker]
+        simulation = transport(instrument(), faults)
+        simulation.start()
+        module = importlib.import_module('DeviceWorkers.twins.%sComm'%(worker))
+        if transport is TCPServer:
+            module.DEVICELOC = simulation.host
+            module.PORT = simulation.port
+            print 'Simulated %s on %s:%i'%(instrument.__name__, simulation.host, simulation.port)
+        else:
+            module.DEVICELOC = simulation.port
+            print 'Simulated %s on %s'%(instrument.__name__, simulation.port)
+        return simulation
+    if worker not in LIBRARY_WORKERS:
+        raise ValueError('No simulation of the %s worker'%(worker))
+    print 'Simulated the libraries of %s'%(worker)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run MTserver against simulated instruments", add_help=False)
+    parser.add_argument("worker", help="the SampleWorker to run: %s"%(', '.join(sorted(INSTRUMENTS.keys() + LIBRARY_WORKERS))))
+    parser.add_argument("--latency", default=0.0, type=float, help="latency of each command to an instrument in ms")
+    parser.add_argument("--jitter", default=0.0, type=float, help="largest random latency added to each command in ms")
+    parser.add_argument("--failure", default=0.0, type=float, help="probability that a command to an instrument fails")
+    parser.add_argument("--seed", default=None, type=int, help="seed of the random latencies and failures")
+
+    args,serverArgs = parser.parse_known_args(sys.argv[1:])
+    faults = SimulatedDevices.Faults(args.latency/1e3, args.jitter/1e3, args.failure, args.seed)
+    simulate(args.worker, faults)
+
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MTserver.py'), args.worker] + serverArgs
+    try:
+        runpy.run_path(sys.argv[0], run_name="__main__")
+    finally:
+        print 'Simulated instruments: %s'%(faults.summary())
@@ -28,6 +28,14 @@ DEVICELOC = "NAME"
 PORT = 0000
 
 class Comm:
+    # Setpoints where only the last value counts, with the positions
+    # of the arguments selecting the channel, see MTWorker
+    COLLAPSIBLE = {'CURRENT': (0,), 'VOLTAGE': (0,),
+                   'BAxialCurrentLim': (), 'BAxialVoltageLim': (),
+                   'BNormCurrentLim': (), 'BNormVoltageLim': (),
+                   'BPerpCurrentLim': (), 'BPerpVoltageLim': (),
+                   'OvenCurrentLim': (), 'OvenVoltageLim': ()}
+
     def __init__(self):  
         try:
             
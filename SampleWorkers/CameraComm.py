@@ -30,6 +30,9 @@ def safely(f):
     return safe_f
 
 class Comm():
+    # Setpoints where only the last value counts, see MTWorker
+    COLLAPSIBLE = {'SETPROPERTY': (0,)}
+
     def __init__(self):
         try: 
             #Initialize camera
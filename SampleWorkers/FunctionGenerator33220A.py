@@ -23,6 +23,9 @@ DEVICELOC = 'NAME'
 
 
 class Comm:
+    # Setpoints where only the last value counts, see MTWorker
+    COLLAPSIBLE = {'Frequency': (), 'Amplitude': ()}
+
     def __init__(self):
         try:
             
@@ -20,6 +20,9 @@ DEBUG = False
 DEVICELOC = 'NAME'
 
 class Comm:
+    # Setpoints where only the last value counts, see MTWorker
+    COLLAPSIBLE = {'SetVoltage': ()}
+
     def __init__(self):
         try:
 
@@ -54,6 +54,14 @@ class newportError:
 
 class Comm:
  
+    # Setpoints where only the last value counts, with the positions
+    # of the arguments selecting the laser, see MTWorker.
+    # PiezoVoltage461/1033 only accept steps below 0.1 from the current
+    # value, so none of their intermediate setpoints may be skipped
+    COLLAPSIBLE = {'SET_PIEZO': (1,), 'SET_DIODE': (1,),
+                   'DiodeCurrent461': (), 'DiodeCurrent1033': (),
+                   'SetOutputPower844TA': ()}
+ 
     def __init__(self):#,sn):
         '''
             Initializes command class. 
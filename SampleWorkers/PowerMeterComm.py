@@ -17,6 +17,14 @@ DEBUG = False
 DEVICENAME = 'NAME'
 
 class Comm:
+    # Setpoints where only the last value counts, see MTWorker
+    COLLAPSIBLE = {'WAVELENGTH': ()}
+
+    # A power reading is reused for 0.2s, by clients and by UPDATE,
+    # a new wavelength makes it stale
+    CACHEABLE = {'POWER': 0.2}
+    CACHE_INVALIDATES = {'WAVELENGTH': ['POWER']}
+
     def __init__(self):
         
         try:
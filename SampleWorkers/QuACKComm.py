@@ -35,6 +35,11 @@ def safely(f):
     return safe_f
 
 class Comm():
+    # Setpoints where only the last value counts, with the positions
+    # of the arguments selecting the channel, see MTWorker
+    COLLAPSIBLE = {'FREQ': (0,1), 'AMP': (0,1), 'PHASE': (0,1),
+                   'DAC': (0,1), 'ELECTRODE': (0,), 'TRAP': (0,), 'DB': (0,)}
+
     def __init__(self):
         try:
             #Initialize QuACK
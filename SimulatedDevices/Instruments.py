@@ -0,0 +1,346 @@
+'''
+    Description:
+    The simulated SCPI instruments of the SampleWorkers, each one with
+    the commands its Comm class sends:
+
+    N6700B       : AgilentBOComm, four channels of a power supply, each
+                   one driving a resistive load
+    Keithley2400 : KeithleyComm, a voltage source measuring its load
+    Agilent33220A: FunctionGenerator33220A, not run by MTsimulate
+    PM100D       : PowerMeterComm, through the fake usbtmc
+    TLB6700      : NewportComm, the lasers, through the fake usbdll
+    TA7600       : NewportComm, the tapered amplifier
+
+    Measurements carry a little gaussian noise so that every UPDATE
+    changes the state as it does with the real instruments.
+'''
+
+import time
+import random
+
+from SimulatedDevices.SCPI import Instrument, parseState
+
+
+# Formats a number as the instruments answer it
+def scpiNumber(value):
+    return '%+.6E'%(value)
+
+
+"""
+The N6700B power supply. A channel whose output is on drives its load of
+LOADS ohms at its voltage level, or at its current level once the load
+draws more, as the real one switches from constant voltage to constant
+current. Commands without a channel list act on channel 1.
+"""
+class N6700B(Instrument):
+    IDN = 'Agilent Technologies,N6700B,SIM0000001,D.02.01'
+    COMMANDS = [('OUTPut[:STATe]', 'setOutput'),
+                ('OUTPut[:STATe]?', 'getOutput'),
+                ('[SOURce:]CURRent[:LEVel][:IMMediate][:AMPLitude]', 'setCurrent'),
+                ('[SOURce:]CURRent[:LEVel][:IMMediate][:AMPLitude]?', 'getCurrent'),
+                ('[SOURce:]VOLTage[:LEVel][:IMMediate][:AMPLitude]', 'setVoltage'),
+                ('[SOURce:]VOLTage[:LEVel][:IMMediate][:AMPLitude]?', 'getVoltage'),
+                ('MEASure[:SCALar]:CURRent[:DC]?', 'measureCurrent'),
+                ('MEASure[:SCALar]:VOLTage[:DC]?', 'measureVoltage')]
+    CHANNELS = 4
+    LOADS = [1.0, 1.0, 1.0, 0.5]
+    NOISE = 1e-4
+
+    def reset(self):
+        self.output = [False]*self.CHANNELS
+        self.current = [0.0]*self.CHANNELS
+        self.voltage = [0.0]*self.CHANNELS
+
+    # The indexes of the channels of a command
+    def indexes(self, channels):
+        for channel in channels or [1]:
+            if not 1 <= channel <= self.CHANNELS:
+                raise IndexError(channel)
+        return [channel - 1 for channel in channels or [1]]
+
+    def operatingPoint(self, i):
+        if not self.output[i]:
+            return 0.0, 0.0
+        voltage = min(self.voltage[i], self.current[i]*self.LOADS[i])
+        return voltage, voltage/self.LOADS[i]
+
+    def setOutput(self, values, channels):
+        for i in self.indexes(channels):
+            self.output[i] = parseState(values[0])
+
+    def getOutput(self, values, channels):
+        return ','.join(str(int(self.output[i])) for i in self.indexes(channels))
+
+    def setCurrent(self, values, channels):
+        for i in self.indexes(channels):
+            self.current[i] = float(values[0])
+
+    def getCurrent(self, values, channels):
+        return ','.join(scpiNumber(self.current[i]) for i in self.indexes(channels))
+
+    def setVoltage(self, values, channels):
+        for i in self.indexes(channels):
+            self.voltage[i] = float(values[0])
+
+    def getVoltage(self, values, channels):
+        return ','.join(scpiNumber(self.voltage[i]) for i in self.indexes(channels))
+
+    def measureCurrent(self, values, channels):
+        return ','.join(scpiNumber(self.operatingPoint(i)[1] + random.gauss(0, self.NOISE))
+                        for i in self.indexes(channels))
+
+    def measureVoltage(self, values, channels):
+        return ','.join(scpiNumber(self.operatingPoint(i)[0] + random.gauss(0, self.NOISE))
+                        for i in self.indexes(channels))
+
+
+"""
+The Keithley 2400 sourcing a voltage into a load of LOAD ohms, the
+thermistor read by KeithleyComm. A measurement answers the voltage,
+current, resistance, time and status as the real one does.
+"""
+class Keithley2400(Instrument):
+    IDN = 'KEITHLEY INSTRUMENTS INC.,MODEL 2400,SIM0001,C30'
+    COMMANDS = [('SYSTem:REMote', 'remote'),
+                ('[SOURce:]VOLTage[:LEVel][:IMMediate][:AMPLitude]', 'setVoltage'),
+                ('[SOURce:]VOLTage[:LEVel][:IMMediate][:AMPLitude]?', 'getVoltage'),
+                ('MEASure[:VOLTage]?', 'measure'),
+                ('READ?', 'measure')]
+    LOAD = 2e4
+    NOISE = 1e-5
+
+    def reset(self):
+        self.voltage = 2.0
+        self.started = time.time()
+
+    def remote(self, values, channels):
+        pass
+
+    def setVoltage(self, values, channels):
+        self.voltage = float(values[0])
+
+    def getVoltage(self, values, channels):
+        return scpiNumber(self.voltage)
+
+    def measure(self, values, channels):
+        voltage = self.voltage + random.gauss(0, self.NOISE)
+        return ','.join([scpiNumber(voltage), scpiNumber(voltage/self.LOAD), scpiNumber(self.LOAD),
+                         scpiNumber(time.time() - self.started), scpiNumber(0)])
+
+
+"""
+The Agilent 33220A function generator, frequency in Hz and amplitude
+and offset in volts.
+"""
+class Agilent33220A(Instrument):
+    IDN = 'Agilent Technologies,33220A,SIM0000001,2.02-2.02-22-2'
+    COMMANDS = [('SYSTem:REMote', 'remote'),
+                ('FUNCtion[:SHAPe]', 'setFunction'),
+                ('FUNCtion[:SHAPe]?', 'getFunction'),
+                ('FREQuency', 'setFrequency'),
+                ('FREQuency?', 'getFrequency'),
+                ('VOLTage[:AMPLitude]', 'setAmplitude'),
+                ('VOLTage[:AMPLitude]?', 'getAmplitude'),
+                ('VOLTage:OFFSet', 'setOffset'),
+                ('VOLTage:OFFSet?', 'getOffset'),
+                ('OUTPut[:STATe]', 'setOutput'),
+                ('OUTPut[:STATe]?', 'getOutput')]
+    FUNCTIONS = ['SIN', 'SQU', 'RAMP', 'PULS', 'NOIS', 'DC', 'USER']
+
+    def reset(self):
+        self.function = 'SIN'
+        self.frequency = 1e3
+        self.amplitude = 0.1
+        self.offset = 0.0
+        self.output = False
+
+    def remote(self, values, channels):
+        pass
+
+    def setFunction(self, values, channels):
+        function = values[0].upper()[:4].rstrip('E')
+        if function not in self.FUNCTIONS:
+            raise ValueError(function)
+        self.function = function
+
+    def getFunction(self, values, channels):
+        return self.function
+
+    def setFrequency(self, values, channels):
+        self.frequency = float(values[0])
+
+    def getFrequency(self, values, channels):
+        return scpiNumber(self.frequency)
+
+    def setAmplitude(self, values, channels):
+        self.amplitude = float(values[0])
+
+    def getAmplitude(self, values, channels):
+        return scpiNumber(self.amplitude)
+
+    def setOffset(self, values, channels):
+        self.offset = float(values[0])
+
+    def getOffset(self, values, channels):
+        return scpiNumber(self.offset)
+
+    def setOutput(self, values, channels):
+        self.output = parseState(values[0])
+
+    def getOutput(self, values, channels):
+        return str(int(self.output))
+
+
+"""
+The Thorlabs PM100D power meter, reading POWER watts of light at every
+wavelength, in nm.
+"""
+class PM100D(Instrument):
+    IDN = 'Thorlabs,PM100D,SIM000001,2.4.0'
+    COMMANDS = [('[SENSe:]CORRection:WAVelength', 'setWavelength'),
+                ('[SENSe:]CORRection:WAVelength?', 'getWavelength'),
+                ('READ?', 'measure'),
+                ('MEASure[:POWer]?', 'measure')]
+    POWER = 1e-3
+    NOISE = 1e-6
+
+    def reset(self):
+        self.wavelength = 780.0
+
+    def setWavelength(self, values, channels):
+        self.wavelength = float(values[0])
+
+    def getWavelength(self, values, channels):
+        return scpiNumber(self.wavelength)
+
+    def measure(self, values, channels):
+        return scpiNumber(self.POWER + random.gauss(0, self.NOISE))
+
+
+"""
+The instruments behind the Newport USB driver end their answers with
+CRLF, answer OK to a command that took effect and VALUE OUT OF RANGE to
+one whose value was refused. ERRSTR? reads the error queue and *STB?
+has bit 2 set while it is not empty.
+"""
+class NewportInstrument(Instrument):
+    TERMINATOR = '\r\n'
+    COMMON = Instrument.COMMON + [('*STB?', 'statusByte'), ('ERRSTR?', 'nextError')]
+
+    def statusByte(self, values, channels):
+        return '%i'%(4 if self.errors else 0)
+
+    # The value of a command, refused outside of [low, high]
+    def inRange(self, values, low, high):
+        value = float(values[0])
+        if not low <= value <= high:
+            raise ValueError(value)
+        return value
+
+    def handle(self, line):
+        errors = len(self.errors)
+        answer = Instrument.handle(self, line)
+        if len(self.errors) > errors and self.errors[-1].startswith('-224'):
+            return 'VALUE OUT OF RANGE'
+        return answer
+
+
+"""
+The TLB-6700 laser controller, piezo voltage in percent and diode
+current in mA, up to MAX_CURRENT.
+"""
+class TLB6700(NewportInstrument):
+    IDN = 'NewFocus 6700 v2.4 02/12/13 SN1147'
+    COMMANDS = [('[SOURce:]VOLTage:PIEZo', 'setPiezo'),
+                ('[SOURce:]VOLTage:PIEZo?', 'getPiezo'),
+                ('[SOURce:]CURRent:DIODe', 'setCurrent'),
+                ('[SOURce:]CURRent:DIODe?', 'getCurrent'),
+                ('SENSe:CURRent:DIODe[?]', 'measureCurrent'),
+                ('OUTPut[:STATe]', 'setOutput'),
+                ('OUTPut[:STATe]?', 'getOutput')]
+    MAX_CURRENT = 165.0
+    NOISE = 0.01
+
+    def reset(self):
+        self.piezo = 50.0
+        self.current = 0.0
+        self.output = False
+
+    def setPiezo(self, values, channels):
+        self.piezo = self.inRange(values, 0.0, 100.0)
+        return 'OK'
+
+    def getPiezo(self, values, channels):
+        return '%.2f'%(self.piezo)
+
+    def setCurrent(self, values, channels):
+        self.current = self.inRange(values, 0.0, self.MAX_CURRENT)
+        return 'OK'
+
+    def getCurrent(self, values, channels):
+        return '%.2f'%(self.current)
+
+    def measureCurrent(self, values, channels):
+        return '%.2f'%(self.current + random.gauss(0, self.NOISE) if self.output else 0.0)
+
+    def setOutput(self, values, channels):
+        self.output = parseState(values[0])
+        return 'OK'
+
+    def getOutput(self, values, channels):
+        return str(int(self.output))
+
+
+"""
+The TA-7600 tapered amplifier, in constant power or in constant current
+mode, powers in mW. Its output is INPUT_POWER times GAIN, up to its power
+set point.
+"""
+class TA7600(NewportInstrument):
+    IDN = 'NewFocus TA-7600 v1.2 SN10012'
+    COMMANDS = [('SOURce:CPOWer', 'setMode'),
+                ('SOURce:CPOWer?', 'getMode'),
+                ('SOURce:POWer:DIODe', 'setPower'),
+                ('SOURce:POWer:DIODe?', 'getPower'),
+                ('SENSe:POWer:DIODe?', 'measurePower'),
+                ('SENSe:POWer:INPut?', 'measureInput'),
+                ('OUTPut[:STATe]', 'setOutput'),
+                ('OUTPut[:STATe]?', 'getOutput')]
+    MAX_POWER = 1500.0
+    INPUT_POWER = 20.0
+    GAIN = 100.0
+    NOISE = 0.1
+
+    def reset(self):
+        self.constantPower = True
+        self.power = 0.0
+        self.output = False
+
+    def setMode(self, values, channels):
+        self.constantPower = parseState(values[0])
+        return 'OK'
+
+    def getMode(self, values, channels):
+        return str(int(self.constantPower))
+
+    def setPower(self, values, channels):
+        self.power = self.inRange(values, 0.0, self.MAX_POWER)
+        return 'OK'
+
+    def getPower(self, values, channels):
+        return '%.1f'%(self.power)
+
+    def measurePower(self, values, channels):
+        if not self.output:
+            return '0.0'
+        return '%.1f'%(min(self.power, self.INPUT_POWER*self.GAIN) + random.gauss(0, self.NOISE))
+
+    def measureInput(self, values, channels):
+        return '%.2f'%(self.INPUT_POWER + random.gauss(0, self.NOISE))
+
+    def setOutput(self, values, channels):
+        self.output = parseState(values[0])
+        return 'OK'
+
+    def getOutput(self, values, channels):
+        return str(int(self.output))
@@ -0,0 +1,193 @@
+'''
+    Description:
+    The simulated Windows libraries of the SampleWorkers, returned by
+    WinDLL in place of ctypes.WinDLL once install() has run:
+
+    usbdll  : NewportComm, the Newport USB driver, each device key a
+              TLB6700 or TA7600 answering the commands written to it
+    wlmData : WaveMeterComm, the HighFinesse wavemeter with the frequency
+              of each channel drifting around FREQUENCIES
+
+    A Library is a ctypes.CDLL, so that it is profiled as the real ones
+    are, whose functions take the same ctypes arguments and accept a
+    restype and argtypes. Every call goes through the FAULTS of the module
+    and a failed call returns the error code of the library.
+'''
+
+import os
+import random
+import threading
+import ctypes
+
+from SimulatedDevices import Faults
+from SimulatedDevices.Instruments import TLB6700, TA7600
+
+# Set by install()
+FAULTS = Faults()
+
+
+# The python value of a ctypes argument
+def value(arg):
+    return getattr(arg, 'value', arg)
+
+
+"""
+A Function of a Library, calling the method of the same name of the
+simulated device
+"""
+class Function:
+    def __init__(self, name, method, device):
+        self.__name__ = name
+        self.method = method
+        self.device = device
+        self.restype = ctypes.c_int
+        self.argtypes = None
+
+    def __call__(self, *args):
+        if FAULTS.apply():
+            return self.device.FAILURE
+        return self.method(*args)
+
+
+"""
+The Library of a simulated device exposes the methods listed in its
+FUNCTIONS. Looking up any other function fails as in ctypes, rather
+than finding it in the libraries of the process as a CDLL would.
+"""
+class Library(ctypes.CDLL):
+    def __init__(self, name, device):
+        self._name = name
+        self._handle = 0
+        self.device = device
+        for function in device.FUNCTIONS:
+            setattr(self, function, Function(function, getattr(device, function), device))
+
+    def __getattr__(self, name):
+        raise AttributeError('function %r not found'%(name))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+"""
+The Newport USB driver. Every command written to a device key is
+answered by its instrument, the answer is kept until it is read.
+"""
+class NewportUSB:
+    FUNCTIONS = ['newp_usb_init_product', 'newp_usb_open_devices', 'newp_usb_get_device_info',
+                 'newp_usb_write_by_key', 'newp_usb_read_by_key', 'newp_usb_uninit_system']
+    FAILURE = -1
+
+    def __init__(self, devices=None):
+        self.devices = devices or {'TLB-6700-LN SN1147': TLB6700(),
+                                   '6700 SN10066': TLB6700(),
+                                   'TA-7600-LN 10012': TA7600()}
+        self.answers = {}
+        self.opened = False
+        self.lock = threading.Lock()
+
+    def newp_usb_init_product(self, productId):
+        return 0
+
+    def newp_usb_open_devices(self, productId, useUsbAddress, numDevices):
+        self.opened = True
+        return 0
+
+    def newp_usb_get_device_info(self, buf):
+        info = ''.join('%i,%s;'%(i + 1, key) for i,key in enumerate(sorted(self.devices)))
+        buf.value = info[:len(buf) - 1]
+        return 0
+
+    def newp_usb_write_by_key(self, key, command, length):
+        key = value(key)
+        if not self.opened or key not in self.devices:
+            return self.FAILURE
+        device = self.devices[key]
+        answer = device.handle(value(command)[:value(length)])
+        self.lock.acquire()
+        try:
+            self.answers[key] = answer + device.TERMINATOR if answer is not None else ''
+        finally:
+            self.lock.release()
+        return 0
+
+    def newp_usb_read_by_key(self, key, buf, length, bytesRead):
+        key = value(key)
+        if not self.opened or key not in self.devices:
+            return self.FAILURE
+        self.lock.acquire()
+        try:
+            answer = self.answers.pop(key, '')[:value(length) - 1]
+        finally:
+            self.lock.release()
+        buf.value = answer
+        bytesRead.contents.value = len(answer)
+        return 0
+
+    def newp_usb_uninit_system(self):
+        self.opened = False
+        return 0
+
+
+"""
+The HighFinesse wavemeter, frequencies in THz and wavelengths in nm.
+The frequency of each channel follows a random walk of DRIFT THz per
+reading around its entry in FREQUENCIES.
+"""
+class WavelengthMeter:
+    FUNCTIONS = ['Instantiate', 'GetFrequencyNum', 'GetWavelengthNum', 'GetFrequency', 'GetWavelength']
+    FAILURE = -1
+    FREQUENCIES = [384.2304844685, 377.1074635, 325.2523, 351.7255, 709.0787, 434.8290, 394.7980, 411.0423]
+    DRIFT = 1e-6
+    SPEED_OF_LIGHT = 299792.458
+
+    def __init__(self):
+        self.frequencies = list(self.FREQUENCIES)
+        self.lock = threading.Lock()
+
+    def Instantiate(self, reason, mode, p1, p2):
+        return 1
+
+    def GetFrequencyNum(self, channel, reserved):
+        channel = value(channel)
+        if not 1 <= channel <= len(self.frequencies):
+            return 0.0
+        self.lock.acquire()
+        try:
+            self.frequencies[channel - 1] += random.gauss(0, self.DRIFT)
+            return self.frequencies[channel - 1]
+        finally:
+            self.lock.release()
+
+    def GetWavelengthNum(self, channel, reserved):
+        frequency = self.GetFrequencyNum(channel, reserved)
+        return self.SPEED_OF_LIGHT/frequency if frequency > 0 else frequency
+
+    def GetFrequency(self, reserved):
+        return self.GetFrequencyNum(1, reserved)
+
+    def GetWavelength(self, reserved):
+        return self.GetWavelengthNum(1, reserved)
+
+
+# The simulated devices by library name
+DEVICES = {'usbdll': NewportUSB, 'wlmData': WavelengthMeter}
+
+# The libraries loaded so far, a library is loaded once
+libraries = {}
+librariesLock = threading.Lock()
+
+
+# Stands in for ctypes.WinDLL, loading the simulated library of a name
+# with or without its path and extension
+def WinDLL(name, *args, **kwargs):
+    key = os.path.splitext(os.path.basename(name))[0]
+    if key not in DEVICES:
+        raise OSError('%s: cannot open shared object file: not simulated'%(name))
+    librariesLock.acquire()
+    try:
+        if key not in libraries:
+            libraries[key] = Library(name, DEVICES[key]())
+        return libraries[key]
+    finally:
+        librariesLock.release()
@@ -0,0 +1,139 @@
+'''
+    Description:
+    The simulated MMCorePy of CameraComm, put in sys.modules by
+    install(). The CMMCore drives one simulated camera of WIDTH x HEIGHT
+    pixels looking at a few gaussian SPOTS, e.g. trapped ions, over a
+    noisy background. The counts of a spot grow with the exposure and
+    the gain, and snapImage takes the exposure time as the real one does.
+
+    Every call that reaches the camera goes through the FAULTS of the
+    module, a failed one raises CMMError.
+'''
+
+import time
+import numpy as np
+
+from SimulatedDevices import Faults
+
+# Set by install()
+FAULTS = Faults()
+
+WIDTH = 2560
+HEIGHT = 2160
+
+# Offset and read noise of the background in counts
+BACKGROUND = 100.0
+READ_NOISE = 5.0
+
+# (x, y, width, counts per ms at a gain of 100) of each spot, in pixels
+# of the whole sensor
+SPOTS = [(804, 45, 4.0, 20.0), (1409, 77, 4.0, 15.0)]
+
+
+class CMMError(Exception):
+    pass
+
+
+"""
+The CMMCore with the devices loaded by their label and their properties
+as strings. The camera device has the Exposure, in ms, Gain and
+PixelType properties and a region of interest.
+"""
+class CMMCore:
+    def __init__(self):
+        self.devices = {}
+        self.camera = None
+        self.roi = [0, 0, WIDTH, HEIGHT]
+        self.image = None
+        self.random = np.random.RandomState()
+
+    # Called by every method reaching a device
+    def command(self, label=None):
+        if FAULTS.apply():
+            raise CMMError('Simulated device error')
+        if label is not None and label not in self.devices:
+            raise CMMError('No device with label "%s"'%(label))
+
+    def loadDevice(self, label, library, name):
+        self.command()
+        self.devices[label] = {'Name': name, 'Library': library, 'Exposure': '10.0',
+                               'Gain': '100', 'PixelType': '16bit', 'Initialized': '0'}
+
+    def initializeDevice(self, label):
+        self.command(label)
+        self.devices[label]['Initialized'] = '1'
+
+    def unloadAllDevices(self):
+        self.devices = {}
+        self.camera = None
+
+    def reset(self):
+        self.unloadAllDevices()
+        self.roi = [0, 0, WIDTH, HEIGHT]
+        self.image = None
+
+    def setCameraDevice(self, label):
+        self.command(label)
+        self.camera = label
+
+    def getCameraDevice(self):
+        return self.camera or ''
+
+    def setProperty(self, label, name, value):
+        self.command(label)
+        self.devices[label][name] = str(value)
+
+    def getProperty(self, label, name):
+        self.command(label)
+        if name not in self.devices[label]:
+            raise CMMError('Property "%s" not found'%(name))
+        return self.devices[label][name]
+
+    def setExposure(self, exposure):
+        self.setProperty(self.camera, 'Exposure', exposure)
+
+    def getExposure(self):
+        return float(self.getProperty(self.camera, 'Exposure'))
+
+    def setROI(self, x, y, width, height):
+        self.command(self.camera)
+        if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > WIDTH or y + height > HEIGHT:
+            raise CMMError('Invalid ROI')
+        self.roi = [int(x), int(y), int(width), int(height)]
+
+    def getROI(self):
+        return list(self.roi)
+
+    def clearROI(self):
+        self.roi = [0, 0, WIDTH, HEIGHT]
+
+    def getImageWidth(self):
+        return self.roi[2]
+
+    def getImageHeight(self):
+        return self.roi[3]
+
+    def snapImage(self):
+        self.command(self.camera)
+        properties = self.devices[self.camera]
+        exposure = float(properties['Exposure'])
+        gain = float(properties['Gain'])
+        time.sleep(exposure/1e3)
+
+        x0,y0,width,height = self.roi
+        image = self.random.normal(BACKGROUND, READ_NOISE, (height, width))
+        xs = np.arange(x0, x0 + width)
+        ys = np.arange(y0, y0 + height)
+        for x,y,sigma,rate in SPOTS:
+            counts = rate*exposure*gain/100.0
+            image += counts*np.outer(np.exp(-(ys - y)**2/(2*sigma**2)), np.exp(-(xs - x)**2/(2*sigma**2)))
+
+        if properties['PixelType'] == '8bit':
+            self.image = np.clip(image, 0, 255).astype(np.uint8)
+        else:
+            self.image = np.clip(image, 0, 65535).astype(np.uint16)
+
+    def getImage(self):
+        if self.image is None:
+            raise CMMError('Camera image buffer read failed')
+        return self.image
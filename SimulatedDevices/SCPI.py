@@ -0,0 +1,242 @@
+'''
+    Description:
+    The SCPI side of the simulated instruments. An Instrument answers
+    command lines the way the real one does, a TCPServer serves it on a
+    socket, as the N6700B is reached over the network, and a SerialPort
+    on a pty, which a Comm class opens with pyserial or os.open as it
+    would the serial port of the real one.
+
+    Headers are matched in their short and long form and in any case,
+    e.g. MEAS:VOLT:DC?, MEASure:VOLTage? and meas:volt? are the same
+    query. An unknown header or a bad parameter goes to the error queue
+    read with SYST:ERR?, the command gets no answer as with the real
+    instruments.
+'''
+
+import re
+import os
+import tty
+import socket
+import select
+import threading
+import collections
+
+from SimulatedDevices import Faults
+
+# Longest line in bytes kept waiting for its end
+MAX_LINE_LENGTH = 4096
+
+CHANNEL_LIST = re.compile(r'\(@([\d,:\s]*)\)')
+
+
+# The regular expression of a SCPI header from its long form, where the
+# lower case letters may be left out and [] are optional nodes, e.g.
+# "[SOURce:]CURRent[:LEVel]"
+def headerPattern(spec):
+    pattern = []
+    for token in re.findall(r'\[|\]|\*?[A-Z]+[a-z]*|[^\[\]A-Za-z]', spec):
+        if token == '[':
+            pattern.append('(?:')
+        elif token == ']':
+            pattern.append(')?')
+        elif token[-1].isalpha():
+            short = token.rstrip('abcdefghijklmnopqrstuvwxyz')
+            rest = token[len(short):]
+            pattern.append(re.escape(short) + ('(?:%s)?'%(rest.upper()) if rest else ''))
+        else:
+            pattern.append(re.escape(token))
+    return re.compile(''.join(pattern) + '$', re.I)
+
+
+# The values and the channels of the parameters of a command,
+# "0.5,(@1:3)" gives (['0.5'], [1, 2, 3])
+def parseParams(params):
+    channels = []
+    match = CHANNEL_LIST.search(params)
+    if match:
+        for part in match.group(1).split(','):
+            first,sep,last = part.partition(':')
+            channels.extend(range(int(first), int(last or first) + 1))
+        params = params[:match.start()] + params[match.end():]
+    values = [value.strip() for value in params.split(',') if value.strip()]
+    return values, channels
+
+
+# Parses a boolean parameter as SCPI does
+def parseState(value):
+    value = value.upper()
+    if value in ('ON', '1'):
+        return True
+    if value in ('OFF', '0'):
+        return False
+    raise ValueError('bad state %s'%(value))
+
+
+"""
+An Instrument holds the state of a simulated device and answers its
+commands. COMMANDS lists the headers it knows, in their long form, with
+the name of the method handling them. The method is called with the
+values and the channels of the parameters and returns the answer, or
+None for a command without one. TERMINATOR ends each answer.
+
+COMMON lists the headers known to every Instrument, *IDN?, *CLS, *RST
+and SYST:ERR?. reset puts it back in its state at power on.
+"""
+class Instrument:
+    IDN = 'SIMULATED,INSTRUMENT,0,0'
+    TERMINATOR = '\n'
+    COMMON = [('*IDN?', 'identify'), ('*CLS', 'clearErrors'), ('*RST', 'resetState'),
+              ('SYSTem:ERRor[:NEXT]?', 'nextError')]
+    COMMANDS = []
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.errors = collections.deque(maxlen=20)
+        self.handlers = [(headerPattern(spec), getattr(self, name)) for spec,name in self.COMMON + self.COMMANDS]
+        self.reset()
+
+    def reset(self):
+        pass
+
+    def handle(self, line):
+        header,sep,params = line.strip().lstrip(':').partition(' ')
+        for pattern,handler in self.handlers:
+            if pattern.match(header):
+                break
+        else:
+            self.errors.append('-113,"Undefined header"')
+            return None
+        self.lock.acquire()
+        try:
+            values,channels = parseParams(params)
+            return handler(values, channels)
+        except (ValueError, IndexError, KeyError):
+            self.errors.append('-224,"Illegal parameter value"')
+            return None
+        finally:
+            self.lock.release()
+
+    def identify(self, values, channels):
+        return self.IDN
+
+    def clearErrors(self, values, channels):
+        self.errors.clear()
+
+    def resetState(self, values, channels):
+        self.reset()
+
+    def nextError(self, values, channels):
+        return self.errors.popleft() if self.errors else '+0,"No error"'
+
+
+# Answers the command lines read from a transport until read returns
+# nothing or running() is false. A command that fails under the
+# faults is lost: it has no effect and gets no answer
+def serveLines(read, write, instrument, faults, running):
+    buf = ''
+    while running():
+        data = read()
+        if data is None:
+            continue
+        if not data:
+            return
+        buf += data
+        lines = buf.split('\n')
+        buf = lines.pop()[-MAX_LINE_LENGTH:]
+        for line in lines:
+            if not line.strip() or faults.apply():
+                continue
+            answer = instrument.handle(line)
+            if answer is not None:
+                write(answer + instrument.TERMINATOR)
+
+
+"""
+The TCPServer serves an Instrument on a TCP port of localhost, port 0
+picks a free one, found in port once started. Each connection is
+served by a thread of its own.
+"""
+class TCPServer(threading.Thread):
+    def __init__(self, instrument, faults=None, port=0, host='127.0.0.1'):
+        threading.Thread.__init__(self, name='SCPI %s'%(instrument.__class__.__name__))
+        self.daemon = True
+        self.instrument = instrument
+        self.faults = faults or Faults()
+        self.running = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(5)
+        self.socket.settimeout(0.2)
+        self.host,self.port = self.socket.getsockname()
+
+    def run(self):
+        while self.running:
+            try:
+                conn,addr = self.socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.serve, args=(conn,), name='SCPI %s:%i'%(addr))
+            thread.daemon = True
+            thread.start()
+        self.socket.close()
+
+    def serve(self, conn):
+        conn.settimeout(0.2)
+        def read():
+            try:
+                return conn.recv(4096)
+            except socket.timeout:
+                return None
+            except socket.error:
+                return ''
+        try:
+            serveLines(read, conn.sendall, self.instrument, self.faults, lambda: self.running)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.running = False
+
+
+"""
+The SerialPort serves an Instrument on a pty, port is the name of the
+device to open in its place, e.g. /dev/pts/5. The pty is raw, it does
+not echo nor translate line ends, and is kept open so that the Comm
+class can close and open it again.
+"""
+class SerialPort(threading.Thread):
+    def __init__(self, instrument, faults=None):
+        threading.Thread.__init__(self, name='Serial %s'%(instrument.__class__.__name__))
+        self.daemon = True
+        self.instrument = instrument
+        self.faults = faults or Faults()
+        self.running = True
+        self.master,self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def run(self):
+        def read():
+            if not select.select([self.master], [], [], 0.2)[0]:
+                return None
+            try:
+                return os.read(self.master, 4096)
+            except OSError:
+                return ''
+        try:
+            serveLines(read, self.write, self.instrument, self.faults, lambda: self.running)
+        finally:
+            os.close(self.master)
+            os.close(self.slave)
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def stop(self):
+        self.running = False
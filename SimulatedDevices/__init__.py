@@ -0,0 +1,83 @@
+'''
+    Description:
+    Simulated instruments standing in for the hardware of the
+    SampleWorkers, so that a Comm class and the whole server can be run
+    and load tested on a plain Linux box. Each simulation speaks the
+    surface the Comm class already uses, the Comm classes are not changed:
+
+    - SCPI instruments, see Instruments: the N6700B power supply behind a
+      TCPServer, the Keithley 2400 behind a SerialPort, a pty the Comm
+      class opens as its serial port, and the 33220A function generator
+    - Libraries: the usbdll of the Newport lasers and the wlmData of the
+      wavemeter, returned by a WinDLL installed in ctypes
+    - the MMCorePy of the camera and the usbtmc of the power meter, as
+      modules of the same name. MMCorePy needs NumPy, the others do not
+
+    Every simulation takes a Faults, the latency and jitter of each
+    command and the probability that it fails. install() puts the fake
+    libraries and modules in place, it has to be called before the Comm
+    module is imported. MTsimulate.py does all of it and runs MTserver.
+'''
+
+import sys
+import time
+import random
+import threading
+import ctypes
+
+
+"""
+The Faults of a simulated device: every command takes latency seconds
+plus up to jitter seconds more, and fails with a probability of
+failure. What a failure looks like depends on the device, a SCPI
+command is lost without an answer, a library call returns an error
+code and MMCorePy raises. commands and failures count them
+"""
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.0, failure=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure = failure
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.failures = 0
+
+    def delay(self):
+        return self.latency + self.jitter*self.random.random()
+
+    # Called for each command, sleeps for its latency and returns True
+    # if it fails
+    def apply(self):
+        self.lock.acquire()
+        try:
+            delay = self.delay()
+            failed = self.random.random() < self.failure
+            self.commands += 1
+            if failed:
+                self.failures += 1
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+        return failed
+
+    def summary(self):
+        return 'latency: %.1fms jitter: %.1fms failure: %.1f%% commands: %i failures: %i'%(
+            1e3*self.latency, 1e3*self.jitter, 100*self.failure, self.commands, self.failures)
+
+
+# Puts the fake libraries and modules in place for the Comm modules
+# imported afterwards: ctypes.WinDLL and usbtmc, and MMCorePy for the
+# camera only since it needs NumPy
+def install(faults=None, camera=False):
+    from SimulatedDevices import Libraries, usbtmc
+    faults = faults or Faults()
+    for module in [Libraries, usbtmc]:
+        module.FAULTS = faults
+    ctypes.WinDLL = Libraries.WinDLL
+    sys.modules['usbtmc'] = usbtmc
+    if camera:
+        from SimulatedDevices import MMCorePy
+        MMCorePy.FAULTS = faults
+        sys.modules['MMCorePy'] = MMCorePy
@@ -0,0 +1,68 @@
+'''
+    Description:
+    The simulated usbtmc of PowerMeterComm, put in sys.modules by
+    install(). An Instrument opened by its USB vendor and product ids
+    talks to the simulated instrument of DEVICES, one per pair of ids
+    and shared by every Instrument opening it.
+
+    Every write goes through the FAULTS of the module. A failed one is
+    lost and the read of its answer times out with a UsbtmcException.
+'''
+
+import threading
+
+from SimulatedDevices import Faults
+from SimulatedDevices.Instruments import PM100D
+
+# Set by install()
+FAULTS = Faults()
+
+# The simulated instruments by (idVendor, idProduct)
+DEVICES = {(0x1313, 0x8078): PM100D}
+
+instruments = {}
+instrumentsLock = threading.Lock()
+
+
+class UsbtmcException(Exception):
+    pass
+
+
+"""
+The Instrument with the write, read and ask of python-usbtmc
+"""
+class Instrument:
+    def __init__(self, idVendor=None, idProduct=None, *args, **kwargs):
+        key = (idVendor, idProduct)
+        if key not in DEVICES:
+            raise UsbtmcException('Device not found')
+        instrumentsLock.acquire()
+        try:
+            if key not in instruments:
+                instruments[key] = DEVICES[key]()
+            self.device = instruments[key]
+        finally:
+            instrumentsLock.release()
+        self.answer = None
+
+    def write(self, message):
+        self.answer = None
+        if FAULTS.apply():
+            return
+        self.answer = self.device.handle(message)
+
+    def read(self, num=-1):
+        answer,self.answer = self.answer,None
+        if answer is None:
+            raise UsbtmcException('Timeout')
+        return answer if num < 0 else answer[:num]
+
+    def ask(self, message, num=-1):
+        self.write(message)
+        return self.read(num)
+
+    def reset(self):
+        self.answer = None
+
+    def close(self):
+        pass